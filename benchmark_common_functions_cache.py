@@ -0,0 +1,335 @@
+# coding: utf-8
+
+# In[ ]:
+
+'''Benchmarks and stress tests of common_functions_cache, together with the old ways of doing things they are compared against.
+None of this is needed to use common_functions_cache. Run this file to do the benchmarks that need no db of your own (with the name of a db as argument
+also benchmark_text_compression on copies of that db), or import it and call them one by one.
+Functions available:
+benchmark_text_compression(db_name, repeat=3) -- db size and scan time with and without compressed text
+stress_test_writers(worker_counts=(1, 2, 4, 8), pages_per_worker=20, page_size=100, fetch_seconds=0.2) -- throughput of several processes writing to one db
+benchmark_xml_parsing(content=None, repeat=5) -- compares the streaming parser for ePMC responses with per-field XPath parsing
+benchmark_get_df(row_counts=(1000, 10000, 100000, 1000000), reference_max_rows=100000) -- time of the get_df dataframe for growing numbers of results
+'''
+
+# In[ ]:
+
+import sqlite3 as lite
+import datetime
+import os
+import random
+import multiprocessing
+import sys
+import shutil
+import tempfile
+import time
+from lxml import etree
+import pandas as pd
+import common_functions_cache as cfc
+
+
+# In[ ]:
+
+def benchmark_text_compression(db_name, repeat = 3):
+    '''Compare the db size and the time of a full scan of the titles and abstracts (like get_df or get_scores over all articles) with uncompressed
+    and compressed text. Works on two temporary copies of the db, the db itself is not changed. Prints the results.
+    The scan reads from the page cache, so it shows the cost of decompressing; reading a db that does not fit in memory from disk gains from the smaller size.
+    kwargs: db_name -- name of SQLite database
+            repeat -- number of scans timed, the best is printed (default = 3)'''
+    
+    temp_dir = tempfile.mkdtemp()
+    
+    try:
+        
+        results = []
+        
+        for enabled in (False, True):
+            
+            copy_name = os.path.join(temp_dir, 'compressed_db' if enabled else 'uncompressed_db')
+            source = cfc._connect(db_name)
+            copy = lite.connect(copy_name)
+            source.backup(copy)
+            source.close()
+            copy.close()
+            
+            cfc.set_text_compression(copy_name, enabled = enabled)
+            
+            conn = cfc._connect(copy_name)
+            timings = []
+            for i in range(repeat):
+                start = time.perf_counter()
+                text_bytes = sum(len(title or '') + len(abstract or '') for title, abstract in conn.execute('select title, abstract from article_text'))
+                timings.append(time.perf_counter() - start)
+            
+            try:
+                table_size = conn.execute("select sum(pgsize) from dbstat where name = 'article_data'").fetchone()[0]
+            except lite.OperationalError: # SQLite without the dbstat table
+                table_size = float('nan')
+            conn.close()
+            
+            results.append(('compressed' if enabled else 'uncompressed', os.path.getsize(copy_name), table_size, min(timings)))
+        
+        print('{:.1f} MB of titles and abstracts'.format(text_bytes / 1e6))
+        for name, size, table_size, scan_time in results:
+            print('{}: db size {:.1f} MB, article_data {:.1f} MB, full scan best of {}: {:.0f} ms'.format(name, size / 1e6, table_size / 1e6, repeat, scan_time * 1000))
+    
+    finally:
+        shutil.rmtree(temp_dir)
+    
+    return None
+
+
+# In[ ]:
+
+def _stress_test_worker(args):
+    '''One writer process of stress_test_writers: a made-up harvest of pages pages of page_size articles, each page taking fetch_seconds to "download".
+    Every page is written like get_pmids_and_article_data does, followed by a flush of scores like get_scores and of links like get_availabilities.
+    Returns the number of articles written.'''
+    
+    db_name, worker_nr, pages, page_size, fetch_seconds = args
+    
+    conn = cfc._connect(db_name)
+    query_id = cfc._retry_locked(conn, cfc._new_query, conn, 'stress test {}'.format(worker_nr), datetime.date.today().strftime('%Y-%m-%d'), 'core', 'get_pmids_and_article_data', page_size, False)
+    
+    def flush(score_rows, link_rows):
+        with conn:
+            conn.executemany('insert or replace into scores(pmid, score, scorer_version) values (?,?,?)', score_rows)
+            conn.executemany('insert or ignore into article_links(pmid, campus_links, request_access) values (?,?,?)', link_rows)
+    
+    for page_nr in range(1, pages + 1):
+        
+        time.sleep(fetch_seconds) # stands in for the ePMC request, other writers use the db meanwhile
+        
+        pmids = [(worker_nr * pages + page_nr - 1) * page_size + i + 1 for i in range(page_size)]
+        records = [{'pmid': str(pmid), 'id': str(pmid), 'title': 'Title of article {}'.format(pmid), 'abstract': 'Abstract of article {}. '.format(pmid) * 20, 'year': '2010',
+                    'journal_title': 'Journal of Medicinal Chemistry', 'journal_abbrev_title': 'J Med Chem', 'in_epmc': 'Y',
+                    'full_text_urls': [('S', 'doi', 'http://dx.doi.org/{}'.format(pmid))]} for pmid in pmids]
+        page = {'page_nr': page_nr, 'hitcount': pages * page_size, 'next_cursor_mark': None, 'results': records}
+        
+        cfc._retry_locked(conn, cfc._write_result_page, conn, query_id, page, 'get_pmids_and_article_data')
+        cfc._retry_locked(conn, flush, [(pmid, random.random(), 'stress_test') for pmid in pmids], [(pmid, None, cfc.SFX_URL.format(pmid)) for pmid in pmids])
+    
+    conn.close()
+    
+    return pages * page_size
+
+
+def stress_test_writers(worker_counts = (1, 2, 4, 8), pages_per_worker = 20, page_size = 100, fetch_seconds = 0.2):
+    '''Check that several processes can write to one db at the same time and show how the throughput scales with their number.
+    For every number of workers a new db is made in a temporary directory and that many processes each do a made-up harvest (see _stress_test_worker),
+    writing pages, scores and links like get_pmids_and_article_data, get_scores and get_availabilities. Prints the articles written per second.
+    While the downloads are the bottleneck the throughput grows with the workers, it levels off once the db is writing all the time.
+    kwargs: worker_counts -- numbers of worker processes to test (default = (1, 2, 4, 8))
+            pages_per_worker -- number of pages each worker writes (default = 20)
+            page_size -- number of articles per page (default = 100)
+            fetch_seconds -- time each page takes to "download" (default = 0.2)'''
+    
+    temp_dir = tempfile.mkdtemp()
+    
+    try:
+        
+        for workers in worker_counts:
+            
+            db_name = os.path.join(temp_dir, 'stress_test_{}_db'.format(workers))
+            cfc.create_db(db_name)
+            
+            pool = multiprocessing.Pool(workers)
+            start = time.perf_counter()
+            try:
+                article_count = sum(pool.map(_stress_test_worker, [(db_name, worker_nr, pages_per_worker, page_size, fetch_seconds) for worker_nr in range(workers)]))
+            finally:
+                pool.close()
+                pool.join()
+            seconds = time.perf_counter() - start
+            
+            conn = cfc._connect(db_name)
+            saved_count = conn.execute('select count(*) from article_data a join scores s on s.pmid = a.pmid join article_links al on al.pmid = a.pmid').fetchone()[0]
+            conn.close()
+            
+            assert saved_count == article_count, "{} articles written but {} saved".format(article_count, saved_count)
+            print('{} workers: {} articles in {:.1f} s, {:.0f} articles/s'.format(workers, article_count, seconds, article_count / seconds))
+    
+    finally:
+        shutil.rmtree(temp_dir)
+    
+    return None
+
+
+# In[ ]:
+
+def _parse_result_page_xpath(content):
+    '''Same output as common_functions_cache._parse_result_page, but the way it used to be done: build the full tree and look up every field with a separate relative XPath.
+    Only kept as the reference for benchmark_xml_parsing.'''
+    
+    tree = etree.fromstring(content)
+    
+    hitcount = tree.xpath('/responseWrapper/hitCount/text()')
+    next_cursor_mark = tree.xpath('/responseWrapper/nextCursorMark/text()')
+    page = {'hitcount': int(hitcount[0]) if hitcount else None, 'next_cursor_mark': next_cursor_mark[0] if next_cursor_mark else None, 'results': []}
+    
+    fields = {'id': 'id/text()', 'pmid': 'pmid/text()', 'title': 'title/text()', 'abstract': 'abstractText/text()', 'year': 'journalInfo/yearOfPublication/text()',
+              'journal_title': 'journalInfo/journal/title/text()', 'journal_abbrev_title': 'journalInfo/journal/medlineAbbreviation/text()', 'in_epmc': 'inEPMC/text()'}
+    
+    for result in tree.xpath('/responseWrapper/resultList/result'):
+        
+        record = {'full_text_urls': []}
+        
+        for field in fields:
+            value = result.xpath(fields[field])
+            if value:
+                record[field] = value[0]
+        
+        for url_item in result.xpath('fullTextUrlList/fullTextUrl'):
+            avail_code = url_item.xpath('availabilityCode/text()')
+            doc_style = url_item.xpath('documentStyle/text()')
+            url = url_item.xpath('url/text()')
+            record['full_text_urls'].append((avail_code[0] if avail_code else None, doc_style[0] if doc_style else None, url[0] if url else None))
+        
+        page['results'].append(record)
+    
+    return page
+
+
+def benchmark_xml_parsing(content = None, repeat = 5):
+    '''Micro-benchmark of the streaming parser used for ePMC responses against the old per-field XPath parsing. Prints the best time of each and checks they give the same records.
+    kwargs: content -- bytes of a saved ePMC core response. If None a response with 1000 made-up core records is used (default = None)
+            repeat -- number of times each parser is run (default = 5)'''
+    
+    if content is None:
+        record = ('<result><id>{0}</id><source>MED</source><pmid>{0}</pmid><title>Title of article {0}</title><authorString>Smith J, Jones K.</authorString>'
+                  '<journalInfo><volume>12</volume><yearOfPublication>2010</yearOfPublication><journal><title>Journal of Medicinal Chemistry</title>'
+                  '<medlineAbbreviation>J Med Chem</medlineAbbreviation></journal></journalInfo><abstractText>{1}</abstractText><inEPMC>Y</inEPMC>'
+                  '<fullTextUrlList><fullTextUrl><availabilityCode>OA</availabilityCode><documentStyle>pdf</documentStyle><url>http://europepmc.org/{0}.pdf</url></fullTextUrl>'
+                  '<fullTextUrl><availabilityCode>S</availabilityCode><documentStyle>doi</documentStyle><url>http://dx.doi.org/{0}</url></fullTextUrl>'
+                  '<fullTextUrl><availabilityCode>F</availabilityCode><documentStyle>html</documentStyle><url>http://europepmc.org/{0}</url></fullTextUrl></fullTextUrlList></result>')
+        abstract = 'L-type calcium channel blockers were tested in a structure-activity relationship study. ' * 15
+        content = ('<?xml version="1.0" encoding="UTF-8"?><responseWrapper><version>5.0</version><hitCount>20000</hitCount><nextCursorMark>AoJ1</nextCursorMark><resultList>'
+                   + ''.join(record.format(10000000 + i, abstract) for i in range(1000)) + '</resultList></responseWrapper>').encode('utf-8')
+    
+    assert cfc._parse_result_page(content) == _parse_result_page_xpath(content), "parsers give different records"
+    
+    for name, parser in [('per-field XPath', _parse_result_page_xpath), ('streaming iterparse', cfc._parse_result_page)]:
+        timings = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            page = parser(content)
+            timings.append(time.perf_counter() - start)
+        print('{}: {} records, best of {}: {:.1f} ms'.format(name, len(page['results']), repeat, min(timings) * 1000))
+    
+    return None
+
+
+# In[ ]:
+
+def _report_df_apply(conn, query_id_list, sql_condition = None, scorer_version = 'HeCaToS_ChEMBLLIKE'):
+    '''Same output as common_functions_cache._report_df, but the way get_df used to do it: select distinct and an apply per value. Only kept as the reference for benchmark_get_df.'''
+    
+    sql = cfc._REPORT_SQL.replace('select', 'select distinct', 1).format(', '.join('?' * len(query_id_list)))
+    
+    if sql_condition != None:
+        sql = sql+' and '+sql_condition
+    
+    def make_into_links(x, link_type):
+        if isinstance(x, str) and x:
+            link_list = x.split(', ')
+            new_link_list = []
+            for index,i in enumerate(link_list):
+                item = '<a target="_blank" href="{}">{}_link_{}</a>'.format(i, link_type, index)
+                new_link_list.append(item)
+            return ', '.join(new_link_list)
+    
+    df = pd.DataFrame(conn.execute(sql, [scorer_version] + list(query_id_list)).fetchall(), columns = cfc._REPORT_COLUMNS)
+    
+    for column, link_type in [('pdf_links', 'pdf'), ('other_links', 'other'), ('campus_links', 'campus'), ('request_access', 'request_access')]:
+        df[column] = df[column].apply(make_into_links, link_type = link_type)
+        df[column + '_boolean'] = df[column].apply(lambda x: 1 if isinstance(x, str) and x else 0)
+        df[column] = df[column].apply(lambda x: x if isinstance(x, str) and x else '')
+    
+    df['avail'] = df['avail'].apply(lambda x: x if isinstance(x, str) and x else '')
+    df['error_comment'] = df['error_comment'].apply(lambda x: x if isinstance(x, str) and x else '')
+    df['pmid_link'] = df['pmid'].apply(lambda x: '<a target="_blank" href="http://www.ncbi.nlm.nih.gov/pubmed/?term={}">{}</a>'.format(x,x))
+    
+    df = df.sort_values(['inChEMBL', 'error_comment', 'request_access_boolean', 'score', 'pdf_links_boolean', 'other_links_boolean', 'campus_links_boolean'],
+                        ascending = [True, True, True, False, False, False, False])
+    df.index = range(1,len(df) + 1)
+    
+    return df
+
+
+def _fill_report_db(db_name, rows, seed = 0):
+    '''Fill a new db made with create_db with rows made-up results of query_id 1 for benchmark_get_df: missing articles, scores with ties and missing scores,
+    ChEMBL articles, 0 to 3 pdf and other links, campus and request links and error records.'''
+    
+    generator = random.Random(seed)
+    conn = cfc._connect(db_name)
+    
+    with conn:
+        conn.execute("insert into queries(query_id, query, hitcount, date_performed) values (1, 'benchmark', ?, '2016-1-1')", (rows,))
+        conn.executemany('insert into result_ids(query_id, pmid) values (1, ?)', [(pmid,) for pmid in range(1, rows + 1)])
+        conn.executemany('insert into chembl_pmids(pmid) values (?)', [(pmid,) for pmid in range(1, rows + 1) if generator.random() < 0.1])
+        
+        def links(kind, pmid):
+            return ', '.join('http://example.org/{}/{}/{}'.format(kind, pmid, i) for i in range(generator.choice([0, 0, 1, 1, 2, 3]))) or None
+        
+        conn.executemany('insert into article_data(pmid, year, title, abstract, journal_title, journal_abbrev_title, in_epmc, avail_codes, pdf_links, other_links) values (?,?,?,?,?,?,?,?,?,?)',
+                         ((pmid, generator.randint(1990, 2016), 'Title {}'.format(pmid), 'Abstract of article {}.'.format(pmid), 'Journal {}'.format(pmid % 500), 'J {}'.format(pmid % 500),
+                           generator.randint(0, 1), generator.choice(['OA, F', 'S', 'F', None]), links('pdf', pmid), links('other', pmid))
+                          for pmid in range(1, rows + 1) if generator.random() < 0.99))
+        conn.executemany('insert into scores(pmid, score) values (?,?)', [(pmid, float(generator.randint(-10, 30))) for pmid in range(1, rows + 1) if generator.random() < 0.9])
+        conn.executemany('insert into article_links(pmid, campus_links, request_access) values (?,?,?)',
+                         [(pmid, 'http://sfx.example.org/{}'.format(pmid), None) if generator.random() < 0.5 else (pmid, None, 'http://sfx.example.org/request/{}'.format(pmid))
+                          for pmid in range(1, rows + 1) if generator.random() < 0.3])
+        conn.executemany('insert into error_records(query_id, pmid, error_comment) values (1,?,?)',
+                         [(pmid, '(get_scores) - status code {}'.format(generator.choice([404, 500]))) for pmid in range(1, rows + 1) if generator.random() < 0.02])
+    
+    conn.close()
+    
+    return None
+
+
+def benchmark_get_df(row_counts = (1000, 10000, 100000, 1000000), reference_max_rows = 100000):
+    '''Time the dataframe of get_df (without the HTML version) for made-up queries of row_counts results each, in a temporary db, and compare with the
+    per-row apply and pandas sort it used to do. Prints the times and checks that both give the same dataframe.
+    kwargs: row_counts -- numbers of results to time (default = (1000, 10000, 100000, 1000000))
+            reference_max_rows -- largest number of results the old way is timed for, it is slow (default = 100000)'''
+    
+    temp_dir = tempfile.mkdtemp()
+    
+    try:
+        
+        for rows in row_counts:
+            
+            db_name = os.path.join(temp_dir, 'report_{}_db'.format(rows))
+            cfc.create_db(db_name)
+            _fill_report_db(db_name, rows)
+            conn = cfc._connect(db_name)
+            
+            start = time.perf_counter()
+            df = cfc._report_df(conn, [1])
+            seconds = time.perf_counter() - start
+            
+            if rows <= reference_max_rows:
+                start = time.perf_counter()
+                reference_df = _report_df_apply(conn, [1])
+                reference_seconds = time.perf_counter() - start
+                assert df.astype(object).equals(reference_df[df.columns].astype(object)), "get_df dataframes differ"
+                print('{} rows: vectorized {:.3f} s, apply {:.3f} s'.format(rows, seconds, reference_seconds))
+            else:
+                print('{} rows: vectorized {:.3f} s'.format(rows, seconds))
+            
+            conn.close()
+    
+    finally:
+        shutil.rmtree(temp_dir)
+    
+    return None
+
+
+# In[ ]:
+
+if __name__ == '__main__':
+    stress_test_writers()
+    benchmark_xml_parsing()
+    benchmark_get_df()
+    if len(sys.argv) > 1:
+        benchmark_text_compression(sys.argv[1])
@@ -7,19 +7,33 @@
 More checks in this version to avoid duplicate retrieval of information from web services. 
 Functions available:
 create_db(db_name)
-pop_chembl_pmids(db_name) -- this populates the chembl_pmids table with pmids from a specific chembl_version.
+migrate_db(db_name) -- upgrade an existing db in place to the current schema version
+set_text_compression(db_name, enabled=True, dictionary_size=32768, sample_size=5000, batch_size=5000) -- store titles and abstracts compressed, or uncompressed again
+pop_chembl_pmids(db_name, chembl_version='chembl_20', source=CHEMBL_LOGIN_FILE, batch_size=10000) -- this populates the chembl_pmids table with pmids from a specific chembl_version.
+diff_chembl_versions(db_name, old_version, new_version) -- pmids added and removed between two loaded ChEMBL versions
 def define_synonym_queries(term_dict_1, term_dict_2 = None, term_dict_3 = None)
-get_hit_profile(query_list)
-get_pmids(query, db_name) -- query is string
-get_article_data(query_id, db_name) -- query is string
-get_pmids_and_article_data(query, db_name) -- query is string
-get_availabilities(query_id, db_name)
-get_scores(query_id, db_name)
-set_chembl_values(query_id, db_name)
-get_df(query_id_list, db_name, sql_condition=None)
-separate_column_df(query_id)
+configure_http(timeout=None, retries=None, backoff=None, backoff_jitter=None, pool_sizes=None) -- settings of the shared HTTP session used for all web calls
+get_hit_profiles(query_list, db_name=None, concurrency=8, cache_days=7) -- dataframe with the number of hits of every query, fetched concurrently and cached
+get_hit_profile(query_list, db_name=None, concurrency=8)
+get_pmids(query, db_name, page_size=25, use_cursor=False, concurrency=1, cache_days=7, return_cache_status=False) -- query is string
+get_article_data(query_id, db_name, page_size=25, use_cursor=False, concurrency=1) -- query is string
+get_pmids_and_article_data(query, db_name, page_size=25, use_cursor=False, concurrency=1, cache_days=7, return_cache_status=False) -- query is string
+resume_query(query_id, db_name, concurrency=1) -- continue an interrupted harvest from its last checkpoint
+refresh_query(query_id, db_name, page_size=25, use_cursor=False, concurrency=1) -- add the records that are new since the query was last harvested
+get_availabilities(query_id, db_name, concurrency=4, flush_every=50, infer_access=True, min_observations=3, verify_fraction=0.1)
+get_scores(query_id, db_name, scorer=None, concurrency=8, requests_per_second=10, flush_every=100)
+hecatos_scorer(concurrency=8, requests_per_second=10) -- scorer using the HeCaToS web service, the default of get_scores
+train_local_scorer(db_name, min_df=3, alpha=1.0) -- local scorer trained on article_data abstracts, labelled by chembl_pmids
+invalidate_scores(db_name, scorer_version) -- remove the cached scores of one scorer version
+set_chembl_values(query_id, db_name) -- no longer needed, in_chembl is kept up to date automatically
+search_cache(expr, db_name, query_id_list=None) -- search the cached titles and abstracts with an ABSTRACT:"..." query, without ePMC
+get_article_urls(query_id_list, db_name, kinds=None) -- the links of the articles of queries, one per row
+get_df(query_id_list, db_name, sql_condition=None, scorer_version='HeCaToS_ChEMBLLIKE')
+separate_column_df(query_id_list, db_name, sql_condition=None, scorer_version='HeCaToS_ChEMBLLIKE')
 colour_terms(df, markup_list)
-plot_scores(query_id_list, db_name)
+plot_scores(query_id_list, db_name, figure_title, scorer_version='HeCaToS_ChEMBLLIKE')
+export_snapshot(db_name, directory, query_id_list=None, file_format='arrow', batch_size=50000) -- write result_ids, article_data, scores and article_links to Arrow/Parquet files
+load_snapshot(directory, table, query_id_list=None) -- open a table of a snapshot, memory-mapped
 '''
 
 
@@ -42,6 +56,520 @@ import datetime
 from IPython.display import HTML
 import lxml.html
 from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import chain, repeat
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import threading
+import sys
+import io
+import hashlib
+import random
+import zlib
+import shutil
+from collections import Counter
+import time
+import scipy.sparse
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+# In[ ]:
+
+HTTP_TIMEOUT = (10, 60) # (connect, read) timeout in seconds for every web call
+HTTP_RETRIES = 5
+HTTP_BACKOFF = 1 # seconds, doubled for every further retry
+HTTP_BACKOFF_JITTER = 1 # up to this many seconds are added at random to every backoff
+HTTP_POOL_SIZES = {'www.ebi.ac.uk': 20, 'scitegic.windows.ebi.ac.uk': 10, 'wtgcsfx.hosted.exlibrisgroup.com': 4}
+HTTP_DEFAULT_POOL_SIZE = 10
+
+_session = None
+_session_lock = threading.Lock()
+
+def configure_http(timeout = None, retries = None, backoff = None, backoff_jitter = None, pool_sizes = None):
+    '''Change the settings of the shared HTTP session used by all functions that call web services (ePMC, HeCaToS and SFX).
+    Only the settings that are given are changed, the session is rebuilt with the new settings on the next request.
+    kwargs: timeout -- seconds, or tuple of (connect, read) seconds (default = None)
+            retries -- number of retries on connection errors and 429/5xx responses (default = None)
+            backoff -- backoff factor in seconds for the exponential backoff between retries (default = None)
+            backoff_jitter -- maximum random number of seconds added to each backoff (default = None)
+            pool_sizes -- dict of host: maximum number of connections open to that host at the same time, further requests wait for a free one (default = None)'''
+    
+    global HTTP_TIMEOUT, HTTP_RETRIES, HTTP_BACKOFF, HTTP_BACKOFF_JITTER, _session
+    
+    with _session_lock:
+        if timeout is not None:
+            HTTP_TIMEOUT = timeout
+        if retries is not None:
+            HTTP_RETRIES = retries
+        if backoff is not None:
+            HTTP_BACKOFF = backoff
+        if backoff_jitter is not None:
+            HTTP_BACKOFF_JITTER = backoff_jitter
+        if pool_sizes is not None:
+            HTTP_POOL_SIZES.update(pool_sizes)
+        if _session is not None:
+            _session.close()
+            _session = None
+    
+    return None
+
+
+def get_session():
+    '''Return the shared requests.Session, created on first use. Connections are kept alive and pooled per host, with at most HTTP_POOL_SIZES connections to the hosts in there,
+    failed requests are retried with exponential backoff and jitter. Can be used from several threads at the same time.'''
+    
+    global _session
+    
+    with _session_lock:
+        
+        if _session is None:
+            
+            retry = Retry(total = HTTP_RETRIES, backoff_factor = HTTP_BACKOFF, backoff_jitter = HTTP_BACKOFF_JITTER, status_forcelist = (429, 500, 502, 503, 504),
+                          allowed_methods = frozenset(['GET']), raise_on_status = False)
+            
+            session = requests.Session()
+            session.mount('http://', HTTPAdapter(pool_maxsize = HTTP_DEFAULT_POOL_SIZE, max_retries = retry))
+            session.mount('https://', HTTPAdapter(pool_maxsize = HTTP_DEFAULT_POOL_SIZE, max_retries = retry))
+            
+            for host, pool_size in HTTP_POOL_SIZES.items():
+                adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = pool_size, pool_block = True, max_retries = retry)
+                session.mount('http://{}/'.format(host), adapter)
+                session.mount('https://{}/'.format(host), adapter)
+            
+            _session = session
+        
+        return _session
+
+
+def _http_get(url, **kwargs):
+    '''GET request through the shared session with the default timeout. kwargs are passed on to requests.'''
+    
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    
+    return get_session().get(url, **kwargs)
+
+
+# In[ ]:
+
+SQLITE_JOURNAL_MODE = 'WAL' # WAL needs shared memory, on a network filesystem (e.g. NFS home directory) set this to 'DELETE' or 'TRUNCATE'
+SQLITE_SYNCHRONOUS = 'NORMAL'
+SQLITE_CACHE_SIZE = -64000 # negative means KiB, so 64 MB of page cache per connection
+SQLITE_BUSY_TIMEOUT = 60 # seconds a connection waits for the write lock when another process is writing to the same db
+SQLITE_LOCK_RETRIES = 5 # times a write is retried when the db stayed locked for longer than SQLITE_BUSY_TIMEOUT
+
+# schema version 1: tables, columns and triggers added after the original schema of create_db
+_ADDED_TABLES = ["create table if not exists query_checkpoints(query_id integer, function_name text, query text, page_size integer, use_cursor integer, last_page integer, cursor_mark text, completed integer, date_updated text, primary key(query_id, function_name))",
+                 "create table if not exists query_refreshes(refresh_id integer primary key, query_id integer, date_performed text, since_date text, last_rowid integer, new_pmids integer)",
+                 "create table if not exists query_refresh_pmids(refresh_id integer, pmid integer, primary key(refresh_id, pmid))",
+                 "create table if not exists query_cache(normalized_query text primary key, query_id integer, resulttype text)",
+                 "create table if not exists hit_profiles(normalized_query text primary key, all_count integer, full_text_count integer, date_performed text)",
+                 "create table if not exists score_cache(text_hash text, scorer_version text, score real, primary key(text_hash, scorer_version))",
+                 "create table if not exists access_inference(journal_title text, year integer, campus_count integer, request_count integer, date_updated text, primary key(journal_title, year))",
+                 "create table if not exists inferred_links(pmid integer primary key, journal_title text, year integer, date_inferred text)",
+                 "create table if not exists chembl_versions(chembl_version text primary key, source text, pmid_count integer, date_loaded text)",
+                 "create table if not exists chembl_version_pmids(chembl_version text, pmid integer, primary key(chembl_version, pmid))"]
+
+# scores of every scorer version side by side (see get_scores), so the scores table is made again keyed on pmid and scorer_version.
+# Scores in dbs from before scorer versions came from the HeCaToS web service.
+_VERSIONED_SCORES_TABLE = "create table scores_versioned(pmid integer, score real, scorer_version text default 'HeCaToS_ChEMBLLIKE', primary key(pmid, scorer_version))"
+
+# triggers keeping article_data.in_chembl equal to membership of chembl_pmids for all articles, on every insert in article_data and every change of chembl_pmids
+_CHEMBL_TRIGGERS = {'article_data_in_chembl': '''create trigger if not exists article_data_in_chembl after insert on article_data begin
+                                                  update article_data set in_chembl = exists(select 1 from chembl_pmids c where c.pmid = new.pmid) where pmid = new.pmid; end''',
+                    'chembl_pmids_insert': '''create trigger if not exists chembl_pmids_insert after insert on chembl_pmids begin
+                                               update article_data set in_chembl = 1 where pmid = new.pmid; end''',
+                    'chembl_pmids_delete': '''create trigger if not exists chembl_pmids_delete after delete on chembl_pmids begin
+                                               update article_data set in_chembl = 0 where pmid = old.pmid; end'''}
+
+# schema version 2: indexes for the lookups of get_df (join on error_records), get_scores (scores per scorer version) and refresh_query.
+# result_ids needs none, all queries look it up by query_id with its primary key
+_INDEXES = ["create index if not exists error_records_query_pmid on error_records(query_id, pmid)",
+            "create index if not exists scores_version on scores(scorer_version, pmid)",
+            "create index if not exists query_refreshes_query on query_refreshes(query_id, refresh_id)"]
+
+# schema version 3: the links of an article one per row, kind is 'pdf' or 'other' (from ePMC) or 'campus' or 'request_access' (from SFX),
+# ordinal is the position of the link in the comma-joined column it also is in (article_data.pdf_links etc.)
+_ARTICLE_URL_TABLES = ["create table if not exists article_urls(pmid integer, kind text, ordinal integer, url text, availability_code text, primary key(pmid, kind, ordinal))",
+                       "create index if not exists article_urls_kind on article_urls(kind, pmid)"]
+
+
+def _migration_1(conn):
+    '''Schema version 1: the tables of the query checkpoints, refreshes and caches, scores keyed on pmid and scorer_version and the in_chembl triggers.'''
+    
+    for sql in _ADDED_TABLES:
+        conn.execute(sql)
+    
+    columns = [row[1] for row in conn.execute('pragma table_info(scores)')]
+    if 'scorer_version' not in columns:
+        conn.execute(_VERSIONED_SCORES_TABLE)
+        conn.execute('insert into scores_versioned(pmid, score) select pmid, score from scores')
+        conn.execute('drop table scores')
+        conn.execute('alter table scores_versioned rename to scores')
+    
+    for sql in _CHEMBL_TRIGGERS.values():
+        conn.execute(sql)
+    
+    _update_in_chembl(conn)
+
+
+def _migration_2(conn):
+    '''Schema version 2: the indexes in _INDEXES.'''
+    
+    for sql in _INDEXES:
+        conn.execute(sql)
+
+
+def _migration_3(conn):
+    '''Schema version 3: the article_urls table, filled from the comma-joined links in article_data and article_links. The availability code of every link
+    is not known for these, only the set of codes of the article in avail_codes, so it is left empty.'''
+    
+    for sql in _ARTICLE_URL_TABLES:
+        conn.execute(sql)
+    
+    url_rows = []
+    
+    for pmid, pdf_links, other_links in conn.execute('select pmid, pdf_links, other_links from article_data where pdf_links is not null or other_links is not null'):
+        url_rows.extend(_link_url_rows(pmid, 'pdf', pdf_links))
+        url_rows.extend(_link_url_rows(pmid, 'other', other_links))
+    
+    for pmid, campus_links, request_access in conn.execute('select pmid, campus_links, request_access from article_links'):
+        url_rows.extend(_link_url_rows(pmid, 'campus', campus_links))
+        url_rows.extend(_link_url_rows(pmid, 'request_access', request_access))
+    
+    conn.executemany('insert or ignore into article_urls(pmid, kind, ordinal, url, availability_code) values (?,?,?,?,?)', url_rows)
+
+
+# schema version 4: full text index over the titles and abstracts of article_data (external content, so the text is not stored twice), kept in sync by triggers.
+# With compressed text (see set_text_compression) the triggers of _COMPRESSED_FTS_TRIGGERS are installed instead, they decompress the text before indexing it
+_FTS_TABLE = "create virtual table if not exists article_fts using fts5(title, abstract, content = 'article_data', content_rowid = 'pmid')"
+
+_FTS_TRIGGERS = ['''create trigger if not exists article_fts_insert after insert on article_data begin
+                    insert into article_fts(rowid, title, abstract) values (new.pmid, new.title, new.abstract); end''',
+                 '''create trigger if not exists article_fts_delete after delete on article_data begin
+                    insert into article_fts(article_fts, rowid, title, abstract) values ('delete', old.pmid, old.title, old.abstract); end''',
+                 '''create trigger if not exists article_fts_update after update of title, abstract on article_data begin
+                    insert into article_fts(article_fts, rowid, title, abstract) values ('delete', old.pmid, old.title, old.abstract);
+                    insert into article_fts(rowid, title, abstract) values (new.pmid, new.title, new.abstract); end''']
+
+_COMPRESSED_FTS_TRIGGERS = ['''create trigger if not exists article_fts_insert after insert on article_data begin
+                               insert into article_fts(rowid, title, abstract) values (new.pmid, decompress_text(new.title), decompress_text(new.abstract)); end''',
+                            '''create trigger if not exists article_fts_delete after delete on article_data begin
+                               insert into article_fts(article_fts, rowid, title, abstract) values ('delete', old.pmid, decompress_text(old.title), decompress_text(old.abstract)); end''',
+                            '''create trigger if not exists article_fts_update after update of title, abstract on article_data begin
+                               insert into article_fts(article_fts, rowid, title, abstract) values ('delete', old.pmid, decompress_text(old.title), decompress_text(old.abstract));
+                               insert into article_fts(rowid, title, abstract) values (new.pmid, decompress_text(new.title), decompress_text(new.abstract)); end''']
+
+def _migration_4(conn):
+    '''Schema version 4: the article_fts full text index, built from the articles already in article_data.
+    Skipped when the SQLite library has no FTS5, search_cache then does not work for this db.'''
+    
+    try:
+        conn.execute(_FTS_TABLE)
+    except lite.OperationalError as e:
+        print('no full text index made, SQLite without FTS5 ({})'.format(e))
+        return
+    
+    for sql in _FTS_TRIGGERS:
+        conn.execute(sql)
+    
+    conn.execute("insert into article_fts(article_fts) values ('rebuild')")
+
+
+# schema version 5: optional compressed storage of titles and abstracts (see set_text_compression). All functions read titles and abstracts from the
+# article_text view, which is article_data as it is. Only while compression is on it is replaced by _COMPRESSED_ARTICLE_TEXT_VIEW, which decompresses the text,
+# so a db without compressed text can still be used from a plain sqlite3 connection
+_TEXT_TABLES = ["create table if not exists text_dictionaries(digest blob primary key, dictionary blob, active integer, date_created text)"]
+
+_ARTICLE_TEXT_VIEW = '''create view if not exists article_text as select pmid, year, title, abstract,
+                        journal_title, journal_abbrev_title, in_epmc, avail_codes, pdf_links, other_links, in_chembl from article_data'''
+
+_COMPRESSED_ARTICLE_TEXT_VIEW = '''create view if not exists article_text as select pmid, year,
+                                   case when typeof(title) = 'blob' then decompress_text(title) else title end as title,
+                                   case when typeof(abstract) = 'blob' then decompress_text(abstract) else abstract end as abstract,
+                                   journal_title, journal_abbrev_title, in_epmc, avail_codes, pdf_links, other_links, in_chembl from article_data'''
+
+def _migration_5(conn):
+    '''Schema version 5: the text_dictionaries table and the article_text view. Nothing is compressed yet, that is done by set_text_compression.'''
+    
+    for sql in _TEXT_TABLES:
+        conn.execute(sql)
+    
+    conn.execute(_ARTICLE_TEXT_VIEW)
+
+
+def _set_text_schema(conn, compressed):
+    '''Install the article_text view and full text index triggers for compressed text (using decompress_text) or for plain text.
+    The full text index itself stays the same, it holds the words of the text either way.'''
+    
+    conn.execute('drop view if exists article_text')
+    conn.execute(_COMPRESSED_ARTICLE_TEXT_VIEW if compressed else _ARTICLE_TEXT_VIEW)
+    
+    if conn.execute("select count(*) from sqlite_master where name = 'article_fts'").fetchone()[0]:
+        for trigger in ('article_fts_insert', 'article_fts_delete', 'article_fts_update'):
+            conn.execute('drop trigger if exists {}'.format(trigger))
+        for sql in (_COMPRESSED_FTS_TRIGGERS if compressed else _FTS_TRIGGERS):
+            conn.execute(sql)
+
+
+# migration n brings a db from schema version n - 1 to n, the version of a db is kept in pragma user_version (0 for dbs from before schema versions)
+_MIGRATIONS = [_migration_1, _migration_2, _migration_3, _migration_4, _migration_5]
+SCHEMA_VERSION = len(_MIGRATIONS)
+
+def _migrate(conn, verbose = False):
+    '''Bring the db of conn to SCHEMA_VERSION by running the migrations it has not had yet, each in its own transaction together with the new user_version.
+    With verbose each migration and its time is printed, some take minutes on a large db (e.g. building the full text index).
+    Returns the schema version the db had.'''
+    
+    version = conn.execute('pragma user_version').fetchone()[0]
+    
+    for new_version in range(version + 1, SCHEMA_VERSION + 1):
+        conn.execute('begin immediate')
+        try:
+            # another process may have done this migration while we waited for the write lock
+            if conn.execute('pragma user_version').fetchone()[0] >= new_version:
+                conn.commit()
+                continue
+            if verbose:
+                print('schema version {} -> {}: {}'.format(new_version - 1, new_version, _MIGRATIONS[new_version - 1].__doc__.split(': ', 1)[1].split('.')[0]))
+                start = time.time()
+            _MIGRATIONS[new_version - 1](conn)
+            conn.execute('pragma user_version = {}'.format(new_version))
+            conn.commit()
+            if verbose:
+                print('    done in {:.1f} s'.format(time.time() - start))
+        except:
+            conn.rollback()
+            raise
+    
+    return version
+
+
+def _connect(db_name, migrate = True):
+    '''Open a connection to the SQLite db with the journal mode, synchronous and cache size pragmas set above.
+    In WAL mode with synchronous = NORMAL a commit does not wait for an fsync of the db file, the db stays consistent after a crash
+    and at most the last transactions are lost. All writes of one ePMC page are done in one transaction, so a harvest is crash-safe per page.
+    A db made by create_db with an older schema version is migrated to SCHEMA_VERSION when it is opened, without printing anything (see migrate_db).
+    The SQL function decompress_text is added to the connection, it is used by the article_text view and the full text index triggers while the text
+    is stored compressed (see set_text_compression).
+    Several processes (e.g. harvests and scoring runs of different queries) can write to the same db at once: a write transaction takes the write lock
+    when it begins (isolation_level IMMEDIATE) and waits up to SQLITE_BUSY_TIMEOUT seconds for another writer to finish. Readers are never blocked in WAL mode.
+    Beginning deferred and taking the lock at the first write would fail at once, without waiting, when another process wrote in between.
+    kwargs: db_name -- name of the SQLite db
+            migrate -- migrate an older db to SCHEMA_VERSION (default = True)'''
+    
+    conn = lite.connect(db_name, timeout = SQLITE_BUSY_TIMEOUT, isolation_level = 'IMMEDIATE')
+    conn.execute('pragma journal_mode = {}'.format(SQLITE_JOURNAL_MODE))
+    conn.execute('pragma synchronous = {}'.format(SQLITE_SYNCHRONOUS))
+    conn.execute('pragma cache_size = {}'.format(SQLITE_CACHE_SIZE))
+    conn.create_function('decompress_text', 1, lambda value: _decompress_text(value, db_name), deterministic = True)
+    
+    if migrate and conn.execute('pragma user_version').fetchone()[0] < SCHEMA_VERSION and conn.execute("select count(*) from sqlite_master where type = 'table' and name = 'queries'").fetchone()[0]:
+        _migrate(conn)
+    
+    return conn
+
+
+def _retry_locked(conn, function, *args, **kwargs):
+    '''Call function(*args, **kwargs), which writes to the db of conn in one transaction. When that fails because other processes held the write lock
+    for longer than SQLITE_BUSY_TIMEOUT, the transaction is rolled back and the call is retried after a random backoff, up to SQLITE_LOCK_RETRIES times.
+    Returns what function returns.'''
+    
+    for attempt in range(SQLITE_LOCK_RETRIES + 1):
+        try:
+            return function(*args, **kwargs)
+        except lite.OperationalError as e:
+            if attempt == SQLITE_LOCK_RETRIES or ('locked' not in str(e) and 'busy' not in str(e)):
+                raise
+            conn.rollback()
+            print('db locked by another writer, retry {} of {}'.format(attempt + 1, SQLITE_LOCK_RETRIES))
+            time.sleep(random.uniform(1, 2) * 2 ** attempt)
+
+
+def migrate_db(db_name):
+    '''Upgrade an existing db (e.g. one made with an older version of these functions) in place to the current schema version SCHEMA_VERSION.
+    This is also done, silently, when a db is opened by any of the functions. This function prints each migration and the time it took,
+    so it is the one to run first on a large db.
+    kwargs: db_name -- name of the SQLite db'''
+    
+    conn = _connect(db_name, migrate = False)
+    old_version = _migrate(conn, verbose = True)
+    new_version = conn.execute('pragma user_version').fetchone()[0]
+    conn.close()
+    
+    print('{}: schema version {} -> {}'.format(db_name, old_version, new_version))
+    
+    return None
+
+
+_TEXT_DICTIONARIES = {} # digest: dictionary of the compression dictionaries used so far, loaded from text_dictionaries when first needed
+
+def _text_dictionary(digest, db_name):
+    '''The compression dictionary with the given digest. When it is not in _TEXT_DICTIONARIES yet it is loaded from the text_dictionaries table
+    of db_name, e.g. when set_text_compression was run by another process after this one opened the db.'''
+    
+    if digest not in _TEXT_DICTIONARIES:
+        conn = lite.connect(db_name, timeout = SQLITE_BUSY_TIMEOUT)
+        row = conn.execute('select dictionary from text_dictionaries where digest = ?', (digest,)).fetchone()
+        conn.close()
+        if row is None:
+            raise KeyError('compression dictionary {} not in {}'.format(digest.hex(), db_name))
+        _TEXT_DICTIONARIES[digest] = bytes(row[0])
+    
+    return _TEXT_DICTIONARIES[digest]
+
+def _compress_text(text, digest):
+    '''Compress a title or abstract with the dictionary with the given digest. The result is a blob of the 4 byte digest followed by the raw deflate data,
+    None stays None.'''
+    
+    if text is None:
+        return None
+    
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, _TEXT_DICTIONARIES[digest])
+    
+    return digest + compressor.compress(text.encode('utf-8')) + compressor.flush()
+
+
+def _decompress_text(value, db_name):
+    '''Inverse of _compress_text, the dictionary is looked up with _text_dictionary in db_name. Text that is not compressed (not a blob) is returned as it is.'''
+    
+    if not isinstance(value, bytes):
+        return value
+    
+    decompressor = zlib.decompressobj(-15, _text_dictionary(value[:4], db_name))
+    
+    return (decompressor.decompress(value[4:]) + decompressor.flush()).decode('utf-8')
+
+
+def _active_text_dictionary(conn):
+    '''Digest of the dictionary new titles and abstracts are compressed with, None when the text is stored uncompressed.
+    The dictionary is added to _TEXT_DICTIONARIES for _compress_text, also when it was made after conn was opened.'''
+    
+    row = conn.execute('select digest from text_dictionaries where active = 1').fetchone()
+    
+    if row is None:
+        return None
+    
+    digest = bytes(row[0])
+    
+    if digest not in _TEXT_DICTIONARIES:
+        _TEXT_DICTIONARIES[digest] = bytes(conn.execute('select dictionary from text_dictionaries where digest = ?', (digest,)).fetchone()[0])
+    
+    return digest
+
+
+def _train_text_dictionary(texts, dictionary_size = 32768):
+    '''Make a zlib preset dictionary from sample texts: the words and runs of 2 and 3 words that save the most (count x length) when they can be
+    referred to, the best ones at the end where deflate refers to them with the shortest distances.'''
+    
+    counts = Counter()
+    
+    for text in texts:
+        words = text.split()
+        for n in (1, 2, 3):
+            counts.update(' '.join(words[i:i + n]) for i in range(len(words) - n + 1))
+    
+    pieces = []
+    size = 0
+    
+    for piece, count in sorted(counts.items(), key = lambda item: (item[1] - 1) * len(item[0]), reverse = True):
+        if count < 2 or size >= dictionary_size:
+            break
+        pieces.append(piece)
+        size += len(piece.encode('utf-8')) + 1
+    
+    return ' '.join(reversed(pieces)).encode('utf-8')[-dictionary_size:]
+
+
+def _update_in_chembl(conn):
+    '''Set in_chembl of all articles in article_data from the chembl_pmids table in one pass, only rows of which the value changes are written.
+    Only needed once for a db from before the in_chembl triggers, after that the triggers keep it up to date.'''
+    
+    return conn.execute('''update article_data set in_chembl = exists(select 1 from chembl_pmids c where c.pmid = article_data.pmid)
+                           where in_chembl is not exists(select 1 from chembl_pmids c where c.pmid = article_data.pmid)''').rowcount
+
+
+def _link_url_rows(pmid, kind, links):
+    '''Rows for the article_urls table (pmid, kind, ordinal, url, availability_code) of a comma-joined string of links as stored in article_data and article_links.'''
+    
+    if not links:
+        return []
+    
+    return [(pmid, kind, ordinal, url, None) for ordinal, url in enumerate(links.split(', '))]
+
+
+def _cached_pmids(conn, pmids):
+    '''Return the set of the given pmids that are already in the article_data table. The pmids are put in a temporary table that is joined
+    on the primary key of article_data, so the cost depends on the number of pmids given (one page) and not on the number of cached articles.
+    kwargs: conn -- connection from _connect
+            pmids -- list of pmids (integers)'''
+    
+    conn.execute('create temp table if not exists page_pmids(pmid integer primary key)')
+    conn.execute('delete from page_pmids')
+    conn.executemany('insert or ignore into page_pmids(pmid) values (?)', [(pmid,) for pmid in pmids])
+    
+    return {row[0] for row in conn.execute('select p.pmid from page_pmids p join article_data a on a.pmid = p.pmid')}
+
+
+def _write_result_page(conn, query_id, page, function_name, save_result_ids = True, save_article_data = True):
+    '''Write one parsed ePMC result page (see _parse_result_page) to the db: the result_ids rows, the article_data rows and the error_records rows
+    are collected first and then inserted with executemany, all in one transaction. Either the whole page is saved or nothing of it.
+    The links of the articles also go in article_urls. The checkpoint of the harvest in query_checkpoints is moved on to this page in the same transaction.
+    kwargs: conn -- connection from _connect
+            query_id -- query_id the results belong to
+            page -- parsed result page
+            function_name -- name of the calling function, used in the error comments
+            save_result_ids -- insert the pmids in result_ids (default = True)
+            save_article_data -- insert the article data in article_data, pmids already in article_data are skipped (default = True)'''
+    
+    if save_article_data:
+        existing_pmids = _cached_pmids(conn, [int(record['pmid']) for record in page['results'] if 'pmid' in record])
+    
+    result_id_rows = []
+    article_rows = []
+    url_rows = []
+    error_rows = []
+    
+    for record in page['results']:
+        
+        if 'pmid' not in record:
+            error_comment = '({}) - IndexError with XML, possibly no pmid for this item or no journal info e.g. when is book chapter'.format(function_name)
+            error_rows.append((query_id, record.get('id'), error_comment))
+            continue
+        
+        pmid = int(record['pmid'])
+        
+        if save_result_ids:
+            result_id_rows.append((query_id, pmid))
+        
+        if not save_article_data or pmid in existing_pmids:
+            continue
+        
+        try:
+            article_rows.append(_article_values(pmid, record))
+            url_rows.extend(_article_url_rows(pmid, record))
+        except IndexError:
+            error_comment = '({}) - IndexError with XML, possibly field not present, e.g. no journal info e.g. when is book chapter'.format(function_name)
+            error_rows.append((query_id, record.get('id'), error_comment))
+    
+    digest = _active_text_dictionary(conn)
+    
+    if digest is not None and article_rows:
+        article_rows = [row[:2] + (_compress_text(row[2], digest), _compress_text(row[3], digest)) + row[4:] for row in article_rows]
+    
+    with conn:
+        conn.executemany("insert or ignore into result_ids(query_id, pmid) values (?,?)", result_id_rows)
+        conn.executemany("insert or ignore into article_data(pmid, year, title, abstract, journal_title, journal_abbrev_title, in_epmc, avail_codes, pdf_links, other_links) values (?,?,?,?,?,?,?,?,?,?)", article_rows)
+        conn.executemany("insert or ignore into article_urls(pmid, kind, ordinal, url, availability_code) values (?,?,?,?,?)", url_rows)
+        conn.executemany("insert or ignore into error_records(query_id, object_id, error_comment) values (?,?,?)", error_rows)
+        conn.execute("update queries set hitcount = ? where query_id = ? and hitcount is null", (page['hitcount'], query_id))
+        conn.execute("update query_checkpoints set last_page = ?, cursor_mark = ?, date_updated = ? where query_id = ? and function_name = ?",
+                     (page['page_nr'], page['next_cursor_mark'], datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), query_id, function_name))
+    
+    return None
 
 
 # In[3]:
@@ -50,7 +578,7 @@ def create_db(db_name):
     '''Create the SQLite database in the current directory.
     kwargs: db_name -- name of the new SQLite db you are creating'''
     
-    conn = lite.connect(db_name)
+    conn = _connect(db_name)
     cursor = conn.cursor()
     
     #create various tables
@@ -65,6 +593,9 @@ def create_db(db_name):
     cursor.execute("create table error_records(query_id integer, object_id text, pmid integer, error_comment text)")
     
     conn.commit()
+    
+    # the tables and indexes added later
+    _migrate(conn)
     conn.close()
     
     return None
@@ -72,43 +603,177 @@ def create_db(db_name):
 
 # In[ ]:
 
-def pop_chembl_pmids(db_name):
-    '''Get all pubmed ids from ChEMBL_20 and populate the chembl_pmids table in the SQLite db with those pmids. Needs a file with login details to ChEMBL database.
-    kwargs: db_name -- name of the SQLite db of which the chembl_pmids table should be updated'''
+def set_text_compression(db_name, enabled = True, dictionary_size = 32768, sample_size = 5000, batch_size = 5000):
+    '''Switch compressed storage of the titles and abstracts in article_data on or off, and convert the articles already in the db.
+    Compression is deflate (zlib) with a preset dictionary trained on a random sample of the abstracts in the db, so also short abstracts compress well.
+    The dictionary is kept in text_dictionaries; a new one is trained every time compression is switched on. Articles harvested afterwards are stored
+    compressed as well. All functions read the text through the article_text view, which decompresses it, so they give the same results.
+    This trades speed for size: every title and abstract read is decompressed by a Python SQL function, one value at a time, so a full scan of the text
+    from the page cache (like get_df, get_scores or export_snapshot over all articles) is about 10 times slower (e.g. 50000 articles: 41 ms -> 547 ms,
+    while the db shrinks from 82 to 52 MB). Only a db much larger than memory, read from disk, can get faster. Measure it on your own db with
+    benchmark_text_compression in benchmark_common_functions_cache.py. While compression is on
+    the article_text view and the full text index triggers use the SQL function decompress_text of _connect, so the db can then only be used through the
+    functions here, not from a plain sqlite3 connection; switching compression off again restores that. The db file only
+    shrinks after the conversion when it is vacuumed, which is done at the end (needs free disk space of the size of the db).
+    kwargs: db_name -- name of SQLite database
+            enabled -- True to compress, False to store all text uncompressed again (default = True)
+            dictionary_size -- size in bytes of the dictionary, deflate uses at most 32768 (default = 32768)
+            sample_size -- number of abstracts the dictionary is trained on (default = 5000)
+            batch_size -- number of articles converted per executemany (default = 5000)'''
+    
+    conn = _connect(db_name)
+    size_before = os.path.getsize(db_name)
+    digest = None
+    
+    with conn:
+        
+        if enabled:
+            sample = [title + ' ' + abstract for title, abstract in conn.execute('''select title, abstract from article_text where abstract is not null
+                                                                                    order by random() limit ?''', (sample_size,))]
+            dictionary = _train_text_dictionary(sample, dictionary_size)
+            digest = hashlib.sha1(dictionary).digest()[:4]
+            _TEXT_DICTIONARIES[digest] = dictionary
+            conn.execute('insert or ignore into text_dictionaries(digest, dictionary, active, date_created) values (?,?,0,?)',
+                         (digest, dictionary, datetime.date.today().strftime('%Y-%m-%d')))
+        
+        conn.execute('update text_dictionaries set active = (digest is ?)', (digest,))
+        
+        # the text itself does not change, so the full text index does not have to be updated. The trigger is put back by _set_text_schema
+        conn.execute('drop trigger if exists article_fts_update')
+        
+        if enabled:
+            cursor = conn.execute('select pmid, title, abstract from article_text')
+        else:
+            cursor = conn.execute("select pmid, title, abstract from article_text where pmid in (select pmid from article_data where typeof(title) = 'blob' or typeof(abstract) = 'blob')")
+        
+        converted = 0
+        
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            if digest is not None:
+                rows = [(pmid, _compress_text(title, digest), _compress_text(abstract, digest)) for pmid, title, abstract in rows]
+            conn.executemany('update article_data set title = ?, abstract = ? where pmid = ?', [(title, abstract, pmid) for pmid, title, abstract in rows])
+            converted += len(rows)
+        
+        # decompress_text is only needed in the view and triggers while there is compressed text
+        _set_text_schema(conn, enabled)
     
-    # get login details from file
-    fileObj = open('/homes/ines/chembl_20_login_details.txt')
-    database = fileObj.read().strip()
-    fileObj.close()
+    conn.execute('vacuum')
+    conn.close()
     
-    conn = cx_Oracle.connect(database)
-    cursor = conn.cursor()
-    chembl_pmid_list = []
+    print('{} articles stored {}, db size {:.1f} MB -> {:.1f} MB'.format(converted, 'compressed' if enabled else 'uncompressed', size_before / 1e6, os.path.getsize(db_name) / 1e6))
     
-    # get all pmids in chembl_20. Need to redo this for new version of chembl
-    sql = '''
-    select distinct pubmed_id from docs where pubmed_id is not null
-    '''
-    cursor.execute(sql)
+    return None
+
+
+# In[ ]:
+
+CHEMBL_LOGIN_FILE = '/homes/ines/chembl_20_login_details.txt'
+CHEMBL_PMID_SQL = 'select distinct pubmed_id from docs where pubmed_id is not null'
+
+def _chembl_pmid_batches(source, batch_size):
+    '''Generator yielding the pmids of a ChEMBL release in lists of at most batch_size, without holding all of them in memory.
+    source is a file with Oracle login details (user/password@dsn on the first line), a ChEMBL SQLite dump (recognised by its header) or a flat file with one pmid per line
+    (first column of a comma or tab separated file, lines that do not start with a number such as a header are skipped).'''
+    
+    with open(source, 'rb') as fileObj:
+        first_line = fileObj.readline(1024)
+    
+    if first_line.startswith(b'SQLite format 3\x00'):
+        conn = lite.connect(source)
+    elif b'@' in first_line:
+        with open(source) as fileObj:
+            conn = cx_Oracle.connect(fileObj.read().strip())
+    else:
+        conn = None
+    
+    if conn is None:
+        with open(source) as fileObj:
+            batch = []
+            for line in fileObj:
+                field = re.split(r'[,\t]', line.strip(), maxsplit = 1)[0].strip('"')
+                if field.isdigit():
+                    batch.append(int(field))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        return
     
-    chembl_pmids_list = [pmid_tuple[0] for pmid_tuple in cursor.fetchall()]
+    try:
+        cursor = conn.cursor()
+        cursor.arraysize = batch_size
+        cursor.execute(CHEMBL_PMID_SQL)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [int(row[0]) for row in rows]
+    finally:
+        conn.close()
 
-    conn.close()
+
+def pop_chembl_pmids(db_name, chembl_version = 'chembl_20', source = CHEMBL_LOGIN_FILE, batch_size = 10000):
+    '''Get all pubmed ids from a ChEMBL release and populate the chembl_pmids table in the SQLite db with those pmids.
+    The source can be the ChEMBL Oracle database (a file with login details), a ChEMBL SQLite dump or a flat file with one pmid per line.
+    The pmids are streamed from the source in batches of batch_size and inserted with executemany, all in one transaction.
+    Every release is kept under its chembl_version in the chembl_version_pmids table and listed in chembl_versions. Afterwards chembl_pmids holds the pmids
+    of this release: pmids that are new are added and pmids no longer in it are removed, the counts are printed (see diff_chembl_versions for the pmids).
+    Loading a version that is already loaded reloads it.
+    kwargs: db_name -- name of the SQLite db of which the chembl_pmids table should be updated
+            chembl_version -- name of the release, e.g. 'chembl_20' (default = 'chembl_20')
+            source -- login details file, SQLite dump or flat file (default = CHEMBL_LOGIN_FILE)
+            batch_size -- number of pmids fetched and inserted at a time (default = 10000)'''
     
-    # open queries_db
-    conn = lite.connect(db_name)
-    cursor = conn.cursor()
+    conn = _connect(db_name)
+    pmid_count = 0
     
-    # insert pmids in chembl_pmids table
-    for pmid in chembl_pmids_list:
-        cursor.execute("insert or ignore into chembl_pmids(pmid) values(?)", (pmid,))
+    with conn:
+        
+        conn.execute('delete from chembl_version_pmids where chembl_version = ?', (chembl_version,))
+        
+        for batch in _chembl_pmid_batches(source, batch_size):
+            conn.executemany('insert or ignore into chembl_version_pmids(chembl_version, pmid) values (?,?)', [(chembl_version, pmid) for pmid in batch])
+            pmid_count += len(batch)
+        
+        conn.execute('insert or replace into chembl_versions(chembl_version, source, pmid_count, date_loaded) values (?,?,?,?)',
+                     (chembl_version, source, pmid_count, datetime.date.today().strftime('%Y-%m-%d')))
+        
+        # make chembl_pmids the set of this version, only the differences are written
+        removed = conn.execute('delete from chembl_pmids where pmid not in (select pmid from chembl_version_pmids where chembl_version = ?)', (chembl_version,)).rowcount
+        added = conn.execute('insert or ignore into chembl_pmids(pmid) select pmid from chembl_version_pmids where chembl_version = ?', (chembl_version,)).rowcount
     
-    conn.commit()
     conn.close()
     
+    print('{}: {} pmids, {} added to and {} removed from chembl_pmids'.format(chembl_version, pmid_count, added, removed))
+    
     return None
 
 
+def diff_chembl_versions(db_name, old_version, new_version):
+    '''Compare the pmids of two ChEMBL releases loaded with pop_chembl_pmids.
+    Return a pandas dataframe with columns pmid and change ('added' when only in new_version, 'removed' when only in old_version).
+    kwargs: db_name
+            old_version -- chembl_version, e.g. 'chembl_20'
+            new_version -- chembl_version, e.g. 'chembl_21' '''
+    
+    conn = _connect(db_name)
+    
+    sql = '''select n.pmid, 'added' as change from chembl_version_pmids n where n.chembl_version = ?
+             and not exists (select 1 from chembl_version_pmids o where o.chembl_version = ? and o.pmid = n.pmid)
+             union all
+             select o.pmid, 'removed' from chembl_version_pmids o where o.chembl_version = ?
+             and not exists (select 1 from chembl_version_pmids n where n.chembl_version = ? and n.pmid = o.pmid)'''
+    
+    diff_df = pd.read_sql(sql, conn, params = (new_version, old_version, old_version, new_version))
+    conn.close()
+    
+    return diff_df
+
+
 # In[4]:
 
 def define_synonym_queries(term_dict_1, term_dict_2 = None, term_dict_3 = None):
@@ -159,272 +824,516 @@ def define_synonym_queries(term_dict_1, term_dict_2 = None, term_dict_3 = None):
 
 # In[ ]:
 
-def get_hit_profile(query_list):
+EPMC_PROFILE_URL = 'http://www.ebi.ac.uk/europepmc/webservices/rest/profile/query=({} AND (src:MED OR src:PMC OR src:CTX))'
+_HIT_PROFILE_CACHE = {}
+
+def _profile_counts(query):
+    '''Fetch the ePMC profile of one query and return (all_count, full_text_count), read from the count attributes of the ALL and FULL TEXT pubTypes.
+    Raises AssertionError when the status code is not 200.'''
     
-    """For each query in query_list print profile hits. This uses the profile module of ePMC webservices. Will print results to console.
-    kwargs: query_list -- list of queries (strings), e.g from define_synonym_queries function."""
+    response = _http_get(EPMC_PROFILE_URL.format(query))
     
-    st_dict = {}
-    base = 'http://www.ebi.ac.uk/europepmc/webservices/rest/profile/query=({} AND (src:MED OR src:PMC OR src:CTX))'
-    total_nr_articles = 0
+    assert response.status_code == 200, 'for query:{} status_code: {}'.format(query, response.status_code)
     
-    for query in query_list:
-            
-        response = requests.get(base.format(query))
-        tree = etree.fromstring(response.content)
-        
-        if response.status_code != 200:
-            print('for query:{} status_code: {}'.format(query, str(response.status_code)))
-            
-        all_result = tree.xpath('/responseWrapper/profileList/pubType[@name="ALL"]')
-        ft_result = tree.xpath('/responseWrapper/profileList/pubType[@name="FULL TEXT"]')
-            
-        all_string = str(etree.tostring(all_result[0], encoding = 'unicode'))
-        ft_string = str(etree.tostring(ft_result[0], encoding = 'unicode'))
-                
-        if re.search(r'count="0"', all_string) == None:
-            st_dict[query] = {'all':int(float(re.search(r'count="([0-9]+)"', all_string).group(1))), 'full text':re.search(r'count="([0-9]+)"', ft_string).group(1)}
-        else:
-            continue
+    counts = {}
+    
+    for pub_type in etree.fromstring(response.content).iterfind('profileList/pubType'):
+        counts[pub_type.get('name')] = int(pub_type.get('count'))
+    
+    return counts.get('ALL', 0), counts.get('FULL TEXT', 0)
+
+
+def get_hit_profiles(query_list, db_name = None, concurrency = 8, cache_days = 7):
+    
+    """Get the number of hits of every query in query_list from the profile module of ePMC webservices, without harvesting anything.
+    The profiles are fetched concurrently and cached per normalized query string: in the hit_profiles table when db_name is given, else in memory for this session.
+    Cached counts younger than cache_days days are used without a request. Queries of which the profile can not be fetched get NaN counts and are printed.
+    Return a pandas dataframe with columns query, all and full_text, one row per query in the order of query_list.
+    kwargs: query_list -- list of queries (strings), e.g from define_synonym_queries function
+            db_name -- name of SQLite db to cache the counts in, None to only cache them in memory (default = None)
+            concurrency -- number of profiles fetched at the same time (default = 8)
+            cache_days -- number of days cached counts are used, None to fetch all profiles again (default = 7)"""
+    
+    current_date = datetime.date.today()
+    keys = [_normalize_query(query) for query in query_list]
+    cached = {}
+    
+    if db_name is None:
+        cached = dict(_HIT_PROFILE_CACHE)
+    else:
+        conn = _connect(db_name)
+        for key, all_count, full_text_count, date_performed in conn.execute('select normalized_query, all_count, full_text_count, date_performed from hit_profiles'):
+            cached[key] = (all_count, full_text_count, datetime.datetime.strptime(date_performed, '%Y-%m-%d').date())
+    
+    counts = {}
+    
+    for key in keys:
+        if key in cached and cache_days is not None and (current_date - cached[key][2]).days < cache_days:
+            counts[key] = cached[key][:2]
+    
+    to_fetch = [(key, query) for key, query in zip(keys, query_list) if key not in counts]
+    to_fetch = list(dict(to_fetch).items()) # every normalized query only once
+    
+    def fetch(item):
+        try:
+            return item[0], _profile_counts(item[1])
+        except (AssertionError, etree.XMLSyntaxError, ValueError, TypeError, requests.RequestException) as e:
+            print('no profile for query:{} ({})'.format(item[1], e))
+            return item[0], None
+    
+    fetched = [(key, result) for key, result in _ordered_map(fetch, to_fetch, concurrency = concurrency) if result is not None]
+    
+    for key, result in fetched:
+        counts[key] = result
+        _HIT_PROFILE_CACHE[key] = result + (current_date,)
+    
+    if db_name is not None:
+        with conn:
+            conn.executemany('insert or replace into hit_profiles(normalized_query, all_count, full_text_count, date_performed) values (?,?,?,?)',
+                             [(key, result[0], result[1], current_date.strftime('%Y-%m-%d')) for key, result in fetched])
+        conn.close()
+    
+    rows = [(query,) + counts.get(key, (np.nan, np.nan)) for key, query in zip(keys, query_list)]
+    
+    return pd.DataFrame(rows, columns = ['query', 'all', 'full_text'])
+
+
+def get_hit_profile(query_list, db_name = None, concurrency = 8):
     
-    for entry in st_dict:
-        print(entry)
-        print(st_dict[entry])
-        total_nr_articles = total_nr_articles + st_dict[entry]['all']
+    """For each query in query_list print profile hits. This uses the profile module of ePMC webservices, see get_hit_profiles. Will print results to console.
+    Queries without hits are left out.
+    kwargs: query_list -- list of queries (strings), e.g from define_synonym_queries function.
+            db_name -- name of SQLite db to cache the counts in (default = None)
+            concurrency -- number of profiles fetched at the same time (default = 8)"""
     
-    print('\n'+'total number of hits = '+str(total_nr_articles))
+    profile_df = get_hit_profiles(query_list, db_name = db_name, concurrency = concurrency)
+    profile_df = profile_df[profile_df['all'] > 0]
+    
+    for row in profile_df.itertuples(index = False):
+        print(row.query)
+        print({'all': int(row.all), 'full text': int(row.full_text)})
+    
+    print('\n'+'total number of hits = '+str(int(profile_df['all'].sum())))
     
     return None
 
 
-# In[5]:
+# In[ ]:
 
-def get_pmids(query, db_name):
-    '''For given query (string) get results in forms of idlist from ePMC. Record the query and date in the queries table. Save pmids associated with the query in the result_ids table.
-    It will be better to use the get_pmids_and_article data function, but if only getting the pmids is required for quick overlap checking, for example, then use this function.
-    Return the query_id assigned to the query in the queries table, can then be used in subsequent functions.
-    kwargs: query -- should be string
-            db_name
-    '''
+_RESULT_FIELDS = {'id': 'id', 'pmid': 'pmid', 'title': 'title', 'abstractText': 'abstract', 'inEPMC': 'in_epmc'}
+
+def _result_record(result):
+    '''Turn one <result> element of an ePMC search response into a compact dict in a single pass over its children.
+    Only the fields present in the XML are set: id, pmid, title, abstract, year, journal_title, journal_abbrev_title, in_epmc,
+    and full_text_urls, a list of (availability_code, document_style, url) tuples. For repeated elements the first one is used, like the XPath lookups did.'''
     
-    moment = datetime.datetime.now()
-    current_date = "{}-{}-{}".format(moment.year, moment.month, moment.day)
+    record = {'full_text_urls': []}
+    
+    for child in result:
+        
+        tag = child.tag
+        
+        if tag in ('id', 'pmid', 'title', 'abstractText', 'inEPMC'):
+            if child.text is not None:
+                record.setdefault(_RESULT_FIELDS[tag], child.text)
+        
+        elif tag == 'journalInfo':
+            for info in child:
+                if info.tag == 'yearOfPublication' and info.text is not None:
+                    record.setdefault('year', info.text)
+                elif info.tag == 'journal':
+                    for journal in info:
+                        if journal.tag == 'title' and journal.text is not None:
+                            record.setdefault('journal_title', journal.text)
+                        elif journal.tag == 'medlineAbbreviation' and journal.text is not None:
+                            record.setdefault('journal_abbrev_title', journal.text)
+        
+        elif tag == 'fullTextUrlList':
+            for url_item in child:
+                url_fields = {}
+                for field in url_item:
+                    if field.text is not None:
+                        url_fields.setdefault(field.tag, field.text)
+                record['full_text_urls'].append((url_fields.get('availabilityCode'), url_fields.get('documentStyle'), url_fields.get('url')))
     
-    base = 'http://www.ebi.ac.uk/europepmc/webservices/rest/search/query=({} AND (src:MED OR src:PMC OR src:CTX))&resulttype=idlist&page={}'
+    return record
+
+
+def _parse_result_page(content):
+    '''Parse the XML content of one ePMC search response (idlist or core) with iterparse. Every <result> is turned into a record (see _result_record)
+    as soon as it has been read and is then freed, so the full tree of a 1000 record page is never held in memory.
+    Returns a dict with hitcount, next_cursor_mark (None when not in the response) and results (list of records).
+    kwargs: content -- bytes of the XML response'''
     
-    conn = lite.connect(db_name)    
-    cursor = conn.cursor()
+    page = {'hitcount': None, 'next_cursor_mark': None, 'results': []}
     
-    def do_query(my_query, page_nr = 1):
+    for event, element in etree.iterparse(io.BytesIO(content), events = ('end',), tag = ('hitCount', 'nextCursorMark', 'result')):
         
-        response = requests.get(base.format(my_query, page_nr))
+        if element.tag == 'result':
+            page['results'].append(_result_record(element))
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
         
-        assert response.status_code == 200
+        elif element.tag == 'hitCount':
+            page['hitcount'] = int(element.text)
         
-        tree = etree.fromstring(response.content)
-        
-        return tree
+        else:
+            page['next_cursor_mark'] = element.text
     
-    def save_pmid(result):
+    return page
+
+
+def _article_values(pmid, record):
+    '''Values for a row of the article_data table (pmid, year, title, abstract, journal_title, journal_abbrev_title, in_epmc, avail_codes, pdf_links, other_links)
+    from a parsed result record. Raises IndexError when a field is missing, e.g. no journal info when the result is a book chapter.'''
+    
+    try:
+        title = record['title']
+        abstract = record['abstract']
+        year = record['year']
+        journal_title = record['journal_title']
+        journal_abbrev_title = record['journal_abbrev_title']
+        in_ePMC = 1 if record['in_epmc'] == 'Y' else 0
+    except KeyError as e:
+        raise IndexError('field not present: {}'.format(e))
+    
+    avail_code_list = []
+    other_links_list = []
+    pdf_links_list = []
+    
+    for avail_code, doc_style, url in record['full_text_urls']:
         
-        pmid = result.xpath('pmid/text()')[0]
+        if avail_code is None or doc_style is None:
+            raise IndexError('availabilityCode or documentStyle not present')
         
-        cursor.execute("insert or ignore into result_ids(query_id, pmid) values (?,?)", (current_query_id, pmid))
+        avail_code_list.append(avail_code)
         
-        return None
+        if doc_style == 'pdf' or avail_code != 'S':
+            if url is None:
+                raise IndexError('url not present')
+            if doc_style == 'pdf':
+                pdf_links_list.append(url)
+            else:
+                other_links_list.append(url)
     
+    avail_codes = ', '.join(set(avail_code_list)) if avail_code_list else None
+    other_links = ', '.join(other_links_list) if other_links_list else None
+    pdf_links = ', '.join(pdf_links_list) if pdf_links_list else None
     
-    tree = do_query(query)
- 
-    result_hitcount = int(tree.xpath('/responseWrapper/hitCount/text()')[0]) 
-    cursor.execute("insert into queries(query_id, query, hitcount, date_performed) values (NULL,?,?,?)", (query, result_hitcount, current_date))
-    current_query_id = cursor.lastrowid
+    return (pmid, year, title, abstract, journal_title, journal_abbrev_title, in_ePMC, avail_codes, pdf_links, other_links)
 
 
-    result_pmids = tree.xpath('/responseWrapper/resultList/result')
+def _article_url_rows(pmid, record):
+    '''Rows for the article_urls table (pmid, kind, ordinal, url, availability_code) of a parsed result record, the same links and order as the pdf_links
+    and other_links of _article_values, together with the availability code of each link. Call after _article_values, which checks the fields are there.'''
+    
+    url_rows = []
+    ordinals = {'pdf': 0, 'other': 0}
+    
+    for avail_code, doc_style, url in record['full_text_urls']:
+        
+        if doc_style == 'pdf' or avail_code != 'S':
+            kind = 'pdf' if doc_style == 'pdf' else 'other'
+            url_rows.append((pmid, kind, ordinals[kind], url, avail_code))
+            ordinals[kind] += 1
+    
+    return url_rows
 
 
-    for item in result_pmids:
+# In[ ]:
+
+EPMC_SEARCH_URL = 'http://www.ebi.ac.uk/europepmc/webservices/rest/search/query=({} AND (src:MED OR src:PMC OR src:CTX))&resulttype={}&page={}&pageSize={}'
+EPMC_CURSOR_SEARCH_URL = 'http://www.ebi.ac.uk/europepmc/webservices/rest/search'
 
+def _ordered_map(function, items, concurrency = 1):
+    '''Generator doing the same as map(function, items) but with up to concurrency calls running at the same time in a thread pool.
+    Results are still yielded in the order of items, so the caller can write them to the db from a single thread. At most 2 x concurrency results are waiting at any time.
+    kwargs: function -- function taking one item
+            items -- iterable of items
+            concurrency -- number of worker threads, 1 means no threads are used (default = 1)'''
+    
+    if concurrency <= 1:
+        for item in items:
+            yield function(item)
+        return
+    
+    with ThreadPoolExecutor(max_workers = concurrency) as executor:
+        pending = deque()
         try:
-            save_pmid(item)
-        except IndexError:
-            object_id = item.xpath('id/text()')[0]
-            error_comment = '(get_pmids) - IndexError with XML, possibly no pmid for this item or no journal info e.g. when is book chapter'
-            cursor.execute("insert or ignore into error_records(query_id, object_id, error_comment) values (?,?,?)", (current_query_id, object_id, error_comment))
-            continue
+            for item in items:
+                pending.append(executor.submit(function, item))
+                if len(pending) >= 2 * concurrency:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _epmc_result_pages(query, resulttype, page_size = 25, use_cursor = False, concurrency = 1, start_page = 1, cursor_mark = '*'):
+    '''Generator yielding every result page of an ePMC search, in order, parsed by _parse_result_page.
+    By default the pages are walked with page=N and the number of pages is worked out from the hitCount of the first page.
+    With use_cursor = True the cursorMark paging of ePMC is used instead: every response gives the cursorMark of the next page and the walk stops on the cursor
+    (cursor no longer moves, or a page with fewer than page_size results) instead of relying on the hitCount.
+    With concurrency > 1 the pages after the first are fetched and parsed in parallel by a thread pool, but still yielded in page order. Cursor paging can not be parallelised
+    because every cursorMark comes from the previous page, so there the next page is fetched while the caller is busy with the current one.
+    The web service is given by EPMC_SEARCH_URL and EPMC_CURSOR_SEARCH_URL, these can be pointed at a local mock server for testing.
+    Every page gets its page_nr, counted from start_page. To continue an interrupted harvest give the page to start from, or with cursor paging the cursorMark of that page.
+    kwargs: query -- string
+            resulttype -- 'idlist' or 'core'
+            page_size -- number of results per page, ePMC allows up to 1000 (default = 25)
+            use_cursor -- use cursorMark paging instead of page numbers (default = False)
+            concurrency -- maximum number of pages fetched at the same time (default = 1)
+            start_page -- number of the first page (default = 1)
+            cursor_mark -- cursorMark of the first page, only used with use_cursor = True (default = '*')'''
+    
+    assert 0 < page_size <= 1000, "page_size should be between 1 and 1000"
+    
+    def do_query(page_nr = None, cursor_mark = None):
+        
+        if cursor_mark is None:
+            response = _http_get(EPMC_SEARCH_URL.format(query, resulttype, page_nr, page_size))
+        else:
+            params = {'query': '({} AND (src:MED OR src:PMC OR src:CTX))'.format(query), 'resultType': resulttype, 'pageSize': page_size, 'cursorMark': cursor_mark, 'format': 'xml'}
+            response = _http_get(EPMC_CURSOR_SEARCH_URL, params = params)
+        
+        assert response.status_code == 200, "status code != 200"
+        
+        page = _parse_result_page(response.content)
+        page['page_nr'] = page_nr
+        
+        return page
+    
+    if use_cursor:
+        
+        page_nr = start_page
+        page = do_query(page_nr, cursor_mark = cursor_mark)
+        
+        with ThreadPoolExecutor(max_workers = 1) as executor:
+            
+            while True:
+                
+                next_cursor_mark = page['next_cursor_mark']
+                
+                if not next_cursor_mark or next_cursor_mark == cursor_mark or len(page['results']) < page_size:
+                    yield page
+                    break
+                
+                cursor_mark = next_cursor_mark
+                page_nr += 1
+                
+                if concurrency > 1:
+                    next_page = executor.submit(do_query, page_nr, cursor_mark = cursor_mark)
+                    yield page
+                    page = next_page.result()
+                else:
+                    yield page
+                    page = do_query(page_nr, cursor_mark = cursor_mark)
+    
+    else:
+        
+        page = do_query(page_nr = start_page)
+        yield page
+        
+        total_pages = max(1, -(-page['hitcount'] // page_size)) # number of pages rounded up
+        
+        #first page was already done so continue from the next one
+        for page in _ordered_map(lambda page_nr: do_query(page_nr = page_nr), range(start_page+1, total_pages+1), concurrency = concurrency):
+            yield page
 
 
-    if (result_hitcount % 25 == 0) and (result_hitcount / 25 > 1): # hitCount is multiple of 25 (remainder==0) but more than one page
-        total_pages = int(result_hitcount / 25)
+def _harvest(conn, query_id, concurrency = 1):
+    '''Run the harvests of query_id that are not completed in the query_checkpoints table, starting from the page after the last completed one.
+    A checkpoint row records the function that started the harvest (get_pmids, get_article_data, get_pmids_and_article_data or refresh_query), the ePMC query, the paging settings, the last completed page and the cursorMark of the next page.
+    It is updated in the same transaction as the results of each page, and set to completed at the end.
+    kwargs: conn -- connection from _connect
+            query_id -- query_id from queries table
+            concurrency -- number of ePMC pages fetched in parallel (default = 1)'''
+    
+    checkpoints = conn.execute("select function_name, query, page_size, use_cursor, last_page, cursor_mark from query_checkpoints where query_id = ? and completed = 0 order by rowid", (query_id,)).fetchall()
+    
+    for function_name, query, page_size, use_cursor, last_page, cursor_mark in checkpoints:
+        
+        resulttype = 'idlist' if function_name == 'get_pmids' else 'core'
+        pages = _epmc_result_pages(query, resulttype, page_size = page_size, use_cursor = bool(use_cursor), concurrency = concurrency, start_page = last_page + 1, cursor_mark = cursor_mark)
+        
+        try:
+            for page in pages:
+                _retry_locked(conn, _write_result_page, conn, query_id, page, function_name, save_result_ids = function_name != 'get_article_data', save_article_data = function_name != 'get_pmids')
+        except Exception:
+            last_page = conn.execute("select last_page from query_checkpoints where query_id = ? and function_name = ?", (query_id, function_name)).fetchone()[0]
+            print('({}) harvest of query_id {} stopped after page {}, continue it with resume_query({}, db_name)'.format(function_name, query_id, last_page, query_id))
+            raise
+        
+        _retry_locked(conn, _complete_harvest, conn, query_id, function_name)
+    
+    return None
 
-    else:  
-        total_pages = (int(result_hitcount // 25)) + 1
 
-    for page in range(2,total_pages+1): #page one was already done so continue from page 2 and add results to same dictionary
+def _complete_harvest(conn, query_id, function_name):
+    '''Set the checkpoint of the harvest of query_id by function_name to completed.
+    For refresh_query the unfinished refresh of query_id in query_refreshes is completed in the same transaction: the pmids added to result_ids
+    since its last_rowid go to query_refresh_pmids and their number to new_pmids.'''
+    
+    with conn:
+        conn.execute("update query_checkpoints set completed = 1, date_updated = ? where query_id = ? and function_name = ?", (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), query_id, function_name))
+        
+        if function_name == 'refresh_query':
+            for refresh_id, last_rowid in conn.execute('select refresh_id, last_rowid from query_refreshes where query_id = ? and new_pmids is null', (query_id,)).fetchall():
+                conn.execute('insert or ignore into query_refresh_pmids(refresh_id, pmid) select ?, pmid from result_ids where query_id = ? and rowid > ?', (refresh_id, query_id, last_rowid))
+                conn.execute('update query_refreshes set new_pmids = (select count(*) from query_refresh_pmids where refresh_id = ?) where refresh_id = ?', (refresh_id, refresh_id))
+    
+    return None
 
-        tree = do_query(query, page_nr = page)
-        result_pmids = tree.xpath('/responseWrapper/resultList/result')
 
-        for item in result_pmids:
+def _new_query(conn, query, current_date, resulttype, function_name, page_size, use_cursor):
+    '''Record a new query in the queries and query_cache tables and add the checkpoint of its harvest by function_name, in one transaction.
+    Returns the new query_id.'''
+    
+    with conn:
+        cursor = conn.execute("insert into queries(query_id, query, hitcount, date_performed) values (NULL,?,?,?)", (query, None, current_date))
+        query_id = cursor.lastrowid
+        conn.execute("insert or replace into query_cache(normalized_query, query_id, resulttype) values (?,?,?)", (_normalize_query(query), query_id, resulttype))
+        _start_harvest(conn, query_id, function_name, query, page_size, use_cursor)
+    
+    return query_id
 
-            try:
-                save_pmid(item)
-            except IndexError:
-                object_id = item.xpath('id/text()')[0]
-                error_comment = '(get_pmids) - IndexError with XML, possibly no pmid for this item or no journal info e.g. when is book chapter'
-                cursor.execute("insert or ignore into error_records(query_id, object_id) values (?,?,?)", (current_query_id, object_id, error_comment))
-                continue
-                        
-    conn.commit()
-    conn.close()
 
-    return current_query_id
+def _start_harvest(cursor, query_id, function_name, query, page_size, use_cursor):
+    '''Add the checkpoint row for a new harvest of query_id to query_checkpoints, at page 0. Replaces an earlier harvest of the same function for that query_id.'''
+    
+    assert 0 < page_size <= 1000, "page_size should be between 1 and 1000"
+    
+    cursor.execute("insert or replace into query_checkpoints(query_id, function_name, query, page_size, use_cursor, last_page, cursor_mark, completed, date_updated) values (?,?,?,?,?,0,'*',0,?)",
+                   (query_id, function_name, query, page_size, int(use_cursor), datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    
+    return None
 
 
-# In[4]:
+# In[ ]:
 
-def get_article_data(query_id, db_name):
-    '''If already perfomed the get_pmids function for a query, now go in more detail and get the article data associated with the pmids form ePMC.
-    Checks whether the pmid already exists in the article_data table and if so, skips that one and does not extract article data from ePMC.
-    Returns None. 
-    kwargs: query_id -- (obtained from get_pmids function)
-            db_name'''
+def _normalize_query(query):
+    '''Normalize a query string for the query cache: whitespace is collapsed, spaces just inside brackets are removed and everything is lower case
+    except the AND, OR and NOT operators. So the same query from define_synonym_queries with different layout or capitals gives the same key.'''
     
-    conn = lite.connect(db_name)    
-    cursor = conn.cursor()
-    
-    base = 'http://www.ebi.ac.uk/europepmc/webservices/rest/search/query=({} AND (src:MED OR src:PMC OR src:CTX))&resulttype=core&page={}'
-    
-    cursor.execute('select query from queries where query_id = ?', (query_id,))
-    query = cursor.fetchall()[0][0]
+    query = ' '.join(query.split())
+    query = re.sub(r'\(\s+', '(', query)
+    query = re.sub(r'\s+\)', ')', query)
     
+    parts = re.split(r'\b(AND|OR|NOT)\b', query)
     
+    return ''.join(part if part in ('AND', 'OR', 'NOT') else part.lower() for part in parts)
 
-    def do_query(my_query, page_nr = 1):
 
-        response = requests.get(base.format(my_query, page_nr))
-        assert response.status_code == 200, "status code != 200"
+def _last_harvest_date(cursor, query_id):
+    '''Date of the last harvest of query_id: the date of its last completed refresh in query_refreshes, or else date_performed in queries.'''
     
-        tree = etree.fromstring(response.content)
-        return tree
-
-    def retrieve_data(result):
+    cursor.execute('select coalesce((select r.date_performed from query_refreshes r where r.query_id = q.query_id and r.new_pmids is not null order by r.refresh_id desc limit 1), q.date_performed) from queries q where q.query_id = ?', (query_id,))
     
-        #pmid = result.xpath('pmid/text()')[0]
-        title = result.xpath('title/text()')[0]
-        abstract = result.xpath('abstractText/text()')[0]
-        year = result.xpath('journalInfo/yearOfPublication/text()')[0]
-        journal_title = result.xpath('journalInfo/journal/title/text()')[0]
-        journal_abbrev_title = result.xpath('journalInfo/journal/medlineAbbreviation/text()')[0]
-        
-        if result.xpath('inEPMC/text()')[0] == 'Y': 
-            in_ePMC = 1 
-        else: 
-            in_ePMC = 0
+    return datetime.datetime.strptime(cursor.fetchall()[0][0], '%Y-%m-%d').date()
 
-        url_list = []
-        avail_code_list = []
-        doc_style_list = []
-        other_links_list = []
-        pdf_links_list = []
-
-        ft_url_list = result.xpath('fullTextUrlList/fullTextUrl')
-        
-        for url_item in ft_url_list:
-            avail_code = url_item.xpath('availabilityCode/text()')[0]
-            avail_code_list.append(avail_code)
-            doc_style = url_item.xpath('documentStyle/text()')[0]
-            doc_style_list.append(doc_style)
 
-            if avail_code != 'S' and doc_style != 'pdf':
-                url = url_item.xpath('url/text()')[0]
-                other_links_list.append(url)
-
-        if 'pdf' in doc_style_list:
-            for url_item in ft_url_list:
-                doc_style = url_item.xpath('documentStyle/text()')[0]
-                if doc_style == 'pdf':
-                    url = url_item.xpath('url/text()')[0]
-                    pdf_links_list.append(url)                        
-        else:
-            pass
-
-        avail_codes = ', '.join(set(avail_code_list)) if avail_code_list else None
-        other_links = ', '.join(other_links_list) if other_links_list else None
-        pdf_links = ', '.join(pdf_links_list) if pdf_links_list else None
-        
-        cursor.execute("insert or ignore into article_data(pmid, year, title, abstract, journal_title, journal_abbrev_title, in_epmc, avail_codes, pdf_links, other_links) values (?,?,?,?,?,?,?,?,?,?)", (pmid, year, title, abstract, journal_title, journal_abbrev_title, in_ePMC, avail_codes, pdf_links, other_links))
-        
-        conn.commit()
-        
-        return None
+def _lookup_query_cache(conn, db_name, query, resulttypes, cache_days, page_size, use_cursor, concurrency):
+    '''Look up query in the query_cache table. Returns (query_id, status) with status:
+    'hit' -- the query was harvested less than cache_days days ago, nothing is downloaded
+    'resumed' -- the earlier harvest was interrupted and has now been continued with resume_query
+    'refreshed' -- the query is older than cache_days days and has now been updated with refresh_query
+    or (None, 'miss') when the query is not in the cache with one of the resulttypes, or cache_days is None.'''
     
-    # now start the tasks
+    if cache_days is None:
+        return None, 'miss'
     
-    cursor.execute('select r.pmid from result_ids r where query_id = ? and r.pmid in (select distinct a.pmid from article_data a)', (query_id,))
-    existing_pmid_list = [i[0] for i in cursor.fetchall()]
-
-    tree = do_query(query)
+    cursor = conn.cursor()
+    cursor.execute('select query_id, resulttype from query_cache where normalized_query = ?', (_normalize_query(query),))
+    row = cursor.fetchone()
+    
+    if row is None or row[1] not in resulttypes:
+        return None, 'miss'
+    
+    query_id = row[0]
+    
+    cursor.execute('select count(*) from query_checkpoints where query_id = ? and completed = 0', (query_id,))
+    
+    if cursor.fetchone()[0] > 0:
+        _harvest(conn, query_id, concurrency = concurrency)
+        return query_id, 'resumed'
     
-    result_abstracts = tree.xpath('/responseWrapper/resultList/result')
-    result_hitcount = int(tree.xpath('/responseWrapper/hitCount/text()')[0]) 
+    if (datetime.date.today() - _last_harvest_date(cursor, query_id)).days < cache_days:
+        return query_id, 'hit'
+    
+    refresh_query(query_id, db_name, page_size = page_size, use_cursor = use_cursor, concurrency = concurrency)
+    
+    return query_id, 'refreshed'
 
-    for item in result_abstracts:
-        try:
-            pmid = int(item.xpath('pmid/text()')[0])
 
-            if pmid in existing_pmid_list:
-                continue
+# In[5]:
 
-            else:
-                try:
-                    retrieve_data(item)
-                except IndexError:
-                    object_id = item.xpath('id/text()')[0]
-                    error_comment = '(get_article_data) - IndexError with XML, possibly field not present, e.g. no journal info e.g. when is book chapter'
-                    cursor.execute("insert or ignore into error_records(query_id, object_id, error_comment) values (?,?,?)", (current_query_id, object_id, error_comment))
-                    continue
-        except IndexError:
-            object_id = item.xpath('id/text()')[0]
-            error_comment = '(get_article_data) - IndexError with XML, possibly no pmid for this item'
-            cursor.execute("insert or ignore into error_records(query_id, object_id, error_comment) values (?,?,?)", (current_query_id, object_id, error_comment))
-            continue
+def get_pmids(query, db_name, page_size = 25, use_cursor = False, concurrency = 1, cache_days = 7, return_cache_status = False):
+    '''For given query (string) get results in forms of idlist from ePMC. Record the query and date in the queries table. Save pmids associated with the query in the result_ids table.
+    It will be better to use the get_pmids_and_article data function, but if only getting the pmids is required for quick overlap checking, for example, then use this function.
+    For large queries use use_cursor = True with a page_size of up to 1000, this uses the cursorMark paging of ePMC and needs far fewer requests.
+    The query is recorded before the first page is fetched and every page is checkpointed, so if the harvest is interrupted it can be continued with resume_query.
+    Queries are cached on their normalized query string: if the same query was already harvested (by this function or get_pmids_and_article_data) less than cache_days days ago,
+    its query_id is returned without downloading anything. An older one is updated with refresh_query and an interrupted one is continued, both keep their query_id.
+    Return the query_id assigned to the query in the queries table, can then be used in subsequent functions.
+    kwargs: query -- should be string
+            db_name
+            page_size -- number of results per ePMC page, at most 1000 (default = 25)
+            use_cursor -- use cursorMark paging instead of page numbers (default = False)
+            concurrency -- number of ePMC pages fetched in parallel, results are still written to the db in page order (default = 1)
+            cache_days -- number of days a cached query is used as it is, None to always do a new harvest (default = 7)
+            return_cache_status -- return a tuple (query_id, status) with status 'hit', 'miss', 'resumed' or 'refreshed' (default = False)
+    '''
+    
+    moment = datetime.datetime.now()
+    current_date = "{}-{}-{}".format(moment.year, moment.month, moment.day)
+    
+    conn = _connect(db_name)    
+    
+    current_query_id, cache_status = _lookup_query_cache(conn, db_name, query, ('idlist', 'core'), cache_days, page_size, use_cursor, concurrency)
+    
+    if current_query_id is None:
         
-    if (result_hitcount % 25 == 0) and (result_hitcount / 25 > 1): # hitCount is multiple of 25 (remainder==0) but more than one page
-        total_pages = int(result_hitcount / 25)
-
-    else:  
-        total_pages = (int(result_hitcount // 25)) + 1 # this holds for cases where there is only one page as well
+        current_query_id = _retry_locked(conn, _new_query, conn, query, current_date, 'idlist', 'get_pmids', page_size, use_cursor)
         
-    for page in range(2,total_pages+1): #page one was already done so continue from page 2 and add results to same dictionary
-
-        tree = do_query(query, page_nr = page)
-        result_abstracts = tree.xpath('/responseWrapper/resultList/result')
-
-        for item in result_abstracts:
-            try:
-                pmid = int(item.xpath('pmid/text()')[0])
+        _harvest(conn, current_query_id, concurrency = concurrency)
+    
+    conn.close()
+    
+    if return_cache_status:
+        return current_query_id, cache_status
 
-                if pmid in existing_pmid_list:
-                    continue
+    return current_query_id
 
-                else:
-                    try:
-                        retrieve_data(item)
-                    except IndexError:
-                        object_id = item.xpath('id/text()')[0]
-                        error_comment = '(get_article_data) - IndexError with XML, possibly field not present, e.g. no journal info e.g. when is book chapter'
-                        cursor.execute("insert or ignore into error_records(query_id, object_id, error_comment) values (?,?,?)", (current_query_id, object_id, error_comment))
-                        continue
-            except IndexError:
-                object_id = item.xpath('id/text()')[0]
-                error_comment = '(get_article_data) - IndexError with XML, possibly no pmid for this item'
-                cursor.execute("insert or ignore into error_records(query_id, object_id, error_comment) values (?,?,?)", (current_query_id, object_id, error_comment))
-                continue
 
+# In[4]:
 
+def get_article_data(query_id, db_name, page_size = 25, use_cursor = False, concurrency = 1):
+    '''If already perfomed the get_pmids function for a query, now go in more detail and get the article data associated with the pmids form ePMC.
+    Checks whether the pmid already exists in the article_data table and if so, skips that one and does not extract article data from ePMC.
+    Every page is checkpointed, so if the harvest is interrupted it can be continued with resume_query.
+    Returns None. 
+    kwargs: query_id -- (obtained from get_pmids function)
+            db_name
+            page_size -- number of results per ePMC page, at most 1000 (default = 25)
+            use_cursor -- use cursorMark paging instead of page numbers (default = False)
+            concurrency -- number of ePMC pages fetched in parallel, results are still written to the db in page order (default = 1)'''
+    
+    conn = _connect(db_name)    
+    cursor = conn.cursor()
+    
+    cursor.execute('select query from queries where query_id = ?', (query_id,))
+    query = cursor.fetchall()[0][0]
+    
+    # now start the tasks
+    
+    _start_harvest(cursor, query_id, 'get_article_data', query, page_size, use_cursor)
     conn.commit()
+    
+    _harvest(conn, query_id, concurrency = concurrency)
+
     conn.close()
     
     return None
@@ -433,247 +1342,401 @@ def get_article_data(query_id, db_name):
 
 # In[5]:
 
-def get_pmids_and_article_data(query, db_name):
+def get_pmids_and_article_data(query, db_name, page_size = 25, use_cursor = False, concurrency = 1, cache_days = 7, return_cache_status = False):
     '''Does same as get_pmids and get_article_data functions but in one step, which I think is faster than doing both separately. Uses the core resulttype from ePMC search module.
     Does not exclude articles that are in chembl because that field is set later.
+    For large queries use use_cursor = True with a page_size of up to 1000, this uses the cursorMark paging of ePMC and needs far fewer requests.
+    The query is recorded before the first page is fetched and every page is checkpointed, so if the harvest is interrupted it can be continued with resume_query.
+    Queries are cached on their normalized query string: if the same query was already harvested by this function less than cache_days days ago,
+    its query_id is returned without downloading anything. An older one is updated with refresh_query and an interrupted one is continued, both keep their query_id.
+    Harvests of different queries (and get_scores and get_availabilities runs) can be run in separate processes on the same db at the same time, each page waits
+    for the write lock (SQLITE_BUSY_TIMEOUT) and is retried when the db stays locked. See stress_test_writers in benchmark_common_functions_cache.py.
     Return the query_id assigned to the query in the queries table, can then be used in subsequent functions.
     kwargs:
             query -- string
             db_name -- name of SQLite db
+            page_size -- number of results per ePMC page, at most 1000 (default = 25)
+            use_cursor -- use cursorMark paging instead of page numbers (default = False)
+            concurrency -- number of ePMC pages fetched in parallel, results are still written to the db in page order (default = 1)
+            cache_days -- number of days a cached query is used as it is, None to always do a new harvest (default = 7)
+            return_cache_status -- return a tuple (query_id, status) with status 'hit', 'miss', 'resumed' or 'refreshed' (default = False)
     
     '''
     
     moment = datetime.datetime.now()
     current_date = "{}-{}-{}".format(moment.year, moment.month, moment.day)
     
-    base = 'http://www.ebi.ac.uk/europepmc/webservices/rest/search/query=({} AND (src:MED OR src:PMC OR src:CTX))&resulttype=core&page={}'
+    conn = _connect(db_name)    
     
-    conn = lite.connect(db_name)    
-    cursor = conn.cursor()
-    new_inserted_count = 0
-    exist_count = 0
+    current_query_id, cache_status = _lookup_query_cache(conn, db_name, query, ('core',), cache_days, page_size, use_cursor, concurrency)
     
-    def do_query(my_query, page_nr = 1):
-        
-        response = requests.get(base.format(my_query, page_nr))
+    if current_query_id is None:
         
-        assert response.status_code == 200
+        current_query_id = _retry_locked(conn, _new_query, conn, query, current_date, 'core', 'get_pmids_and_article_data', page_size, use_cursor)
         
-        tree = etree.fromstring(response.content)
-        
-        return tree
-
-    def retrieve_data(result):
+        _harvest(conn, current_query_id, concurrency = concurrency)
+            
+    conn.close()
     
-        #pmid = result.xpath('pmid/text()')[0]
-        title = result.xpath('title/text()')[0]
-        abstract = result.xpath('abstractText/text()')[0]
-        year = result.xpath('journalInfo/yearOfPublication/text()')[0]
-        journal_title = result.xpath('journalInfo/journal/title/text()')[0]
-        journal_abbrev_title = result.xpath('journalInfo/journal/medlineAbbreviation/text()')[0]
-        
-        if result.xpath('inEPMC/text()')[0] == 'Y': 
-            in_ePMC = 1 
-        else: 
-            in_ePMC = 0
+    if return_cache_status:
+        return current_query_id, cache_status
+    
+    return current_query_id
 
-        url_list = []
-        avail_code_list = []
-        doc_style_list = []
-        other_links_list = []
-        pdf_links_list = []
 
-        ft_url_list = result.xpath('fullTextUrlList/fullTextUrl')
-        
-        for url_item in ft_url_list:
-            avail_code = url_item.xpath('availabilityCode/text()')[0]
-            avail_code_list.append(avail_code)
-            doc_style = url_item.xpath('documentStyle/text()')[0]
-            doc_style_list.append(doc_style)
+# In[ ]:
 
-            if avail_code != 'S' and doc_style != 'pdf':
-                url = url_item.xpath('url/text()')[0]
-                other_links_list.append(url)
+def resume_query(query_id, db_name, concurrency = 1):
+    '''Continue an interrupted harvest (get_pmids, get_article_data or get_pmids_and_article_data) of query_id from its last checkpoint.
+    The pages that were already saved are not downloaded again, the same query and paging settings (page_size, use_cursor) as the original harvest are used.
+    Unfinished harvests are those with completed = 0 in the query_checkpoints table. Does nothing if all harvests of query_id are completed.
+    Return the query_id.
+    kwargs: query_id -- query_id from queries table
+            db_name -- name of SQLite db
+            concurrency -- number of ePMC pages fetched in parallel (default = 1)'''
+    
+    conn = _connect(db_name)
+    
+    _harvest(conn, query_id, concurrency = concurrency)
+    
+    conn.close()
+    
+    return query_id
 
-        if 'pdf' in doc_style_list:
-            for url_item in ft_url_list:
-                doc_style = url_item.xpath('documentStyle/text()')[0]
-                if doc_style == 'pdf':
-                    url = url_item.xpath('url/text()')[0]
-                    pdf_links_list.append(url)                        
+
+# In[ ]:
+
+def refresh_query(query_id, db_name, page_size = 25, use_cursor = False, concurrency = 1):
+    '''Bring a stored query up to date without harvesting it again. Only the records created in ePMC or first published since the last time the query was harvested
+    (date_performed in queries, or the last refresh in query_refreshes) are fetched, by adding a CREATION_DATE/FIRST_PDATE filter to the query.
+    Their pmids are added to result_ids under the same query_id and their article data is saved as in get_pmids_and_article_data.
+    The refresh is recorded in query_refreshes before harvesting, and completed with the number of new pmids (the new pmids themselves are in query_refresh_pmids)
+    when the harvest finishes, also when an interrupted refresh is finished with resume_query. Running refresh_query again instead restarts the interrupted refresh.
+    Return the query_id.
+    kwargs: query_id -- query_id from queries table
+            db_name -- name of SQLite db
+            page_size -- number of results per ePMC page, at most 1000 (default = 25)
+            use_cursor -- use cursorMark paging instead of page numbers (default = False)
+            concurrency -- number of ePMC pages fetched in parallel (default = 1)'''
+    
+    moment = datetime.datetime.now()
+    current_date = "{}-{}-{}".format(moment.year, moment.month, moment.day)
+    
+    conn = _connect(db_name)
+    cursor = conn.cursor()
+    
+    cursor.execute('select query from queries where query_id = ?', (query_id,))
+    query = cursor.fetchall()[0][0]
+    
+    # records of the last day are fetched again, they are only added once to result_ids
+    since_date = _last_harvest_date(cursor, query_id).strftime('%Y-%m-%d')
+    refresh_query_string = '({}) AND (CREATION_DATE:[{} TO 3000-12-31] OR FIRST_PDATE:[{} TO 3000-12-31])'.format(query, since_date, since_date)
+    
+    # pmids added to result_ids after last_rowid are the new pmids of this refresh, an interrupted refresh of query_id keeps its own last_rowid
+    cursor.execute('select refresh_id from query_refreshes where query_id = ? and new_pmids is null', (query_id,))
+    row = cursor.fetchone()
+    
+    with conn:
+        if row is None:
+            cursor.execute('insert into query_refreshes(refresh_id, query_id, date_performed, since_date, last_rowid) values (NULL,?,?,?,(select coalesce(max(rowid), 0) from result_ids))', (query_id, current_date, since_date))
+            refresh_id = cursor.lastrowid
         else:
-            pass
+            refresh_id = row[0]
+            cursor.execute('update query_refreshes set date_performed = ?, since_date = ? where refresh_id = ?', (current_date, since_date, refresh_id))
+        _start_harvest(cursor, query_id, 'refresh_query', refresh_query_string, page_size, use_cursor)
+    
+    _harvest(conn, query_id, concurrency = concurrency)
+    
+    cursor.execute('select new_pmids from query_refreshes where refresh_id = ?', (refresh_id,))
+    print('query_id {}: {} new pmids since {}'.format(query_id, cursor.fetchall()[0][0], since_date))
+    
+    conn.close()
+    
+    return query_id
 
-        avail_codes = ', '.join(set(avail_code_list)) if avail_code_list else None
-        other_links = ', '.join(other_links_list) if other_links_list else None
-        pdf_links = ', '.join(pdf_links_list) if pdf_links_list else None
-        
-        #cursor.execute("insert or ignore into result_ids(query_id, pmid) values(?,?)", (current_query_id, pmid))
-        
-        cursor.execute("insert or ignore into article_data(pmid, year, title, abstract, journal_title, journal_abbrev_title, in_epmc, avail_codes, pdf_links, other_links) values (?,?,?,?,?,?,?,?,?,?)", (pmid, year, title, abstract, journal_title, journal_abbrev_title, in_ePMC, avail_codes, pdf_links, other_links))
-        
-        conn.commit()
-        
-        return None
 
-    tree = do_query(query)
- 
-    result_hitcount = int(tree.xpath('/responseWrapper/hitCount/text()')[0]) 
-    cursor.execute("insert into queries(query_id, query, hitcount, date_performed) values (NULL,?,?,?)", (query, result_hitcount, current_date))
-    current_query_id = cursor.lastrowid
+# In[9]:
+
+SCORE_URL = 'http://scitegic.windows.ebi.ac.uk:9955/rest/HeCaToS_ChEMBLLIKE/{}/{}'
 
-    result_abstracts = tree.xpath('/responseWrapper/resultList/result')
+def _rate_limiter(requests_per_second):
+    '''Return a function that blocks until the next request may be sent, so that all threads calling it together send at most requests_per_second requests per second.
+    None or 0 means no limit.'''
+    
+    lock = threading.Lock()
+    next_time = [time.monotonic()]
     
-    cursor.execute('select distinct pmid from article_data')
-    existing_pmid_list = [i[0] for i in cursor.fetchall()]
-    #print(len(existing_pmid_list))
-    #print(existing_pmid_list[:10])
+    def wait():
+        if not requests_per_second:
+            return
+        with lock:
+            now = time.monotonic()
+            start = max(now, next_time[0])
+            next_time[0] = start + 1.0 / requests_per_second
+        if start > now:
+            sleep(start - now)
+    
+    return wait
 
-    for item in result_abstracts:
-        try:
-            pmid = int(item.xpath('pmid/text()')[0])
-            #print(pmid)
-            cursor.execute("insert or ignore into result_ids(query_id, pmid) values(?,?)", (current_query_id, pmid))
 
-            if (pmid in existing_pmid_list) == True:
-                #exist_count += 1
-                continue
-            else:
-                try:
-                    retrieve_data(item)
-                    #new_inserted_count += 1
-                except IndexError:
-                    object_id = item.xpath('id/text()')[0]
-                    error_comment = '(get_pmids_and_article_data) - IndexError with XML, possibly field not present, e.g. no journal info e.g. when is book chapter'
-                    cursor.execute("insert or ignore into error_records(query_id, object_id, error_comment) values (?,?,?)", (current_query_id, object_id, error_comment))
-                    continue
-        except IndexError:
-            object_id = item.xpath('id/text()')[0]
-            error_comment = '(get_pmids_and_article_data) - IndexError with XML, possibly no pmid for this item or no journal info e.g. when is book chapter'
-            cursor.execute("insert or ignore into error_records(query_id, object_id, error_comment) values (?,?,?)", (current_query_id, object_id, error_comment))
-            continue
+def _score_article(item):
+    '''Get the ChEMBL-likeness score of one (pmid, title, abstract) from the web service at SCORE_URL, title and abstract are sent base64 encoded.
+    Returns (pmid, score, None), or (pmid, None, error_info) when no score could be retrieved.'''
+    
+    pmid, title, abstract = item
+    response_0 = None
+    
+    try:
+        post_title = base64.b64encode(title.encode('utf-8')).decode('ascii')
+        post_abstract = base64.b64encode(abstract.encode('utf-8')).decode('ascii')
         
-    if (result_hitcount % 25 == 0) and (result_hitcount / 25 > 1): # hitCount is multiple of 25 (remainder==0) but more than one page
-        total_pages = int(result_hitcount / 25)
+        response_0 = _http_get(SCORE_URL.format(post_title, post_abstract))
+        response = response_0.json()
+        
+        return pmid, float(response['score']), None
+    
+    except (ValueError, KeyError, TypeError):
+        return pmid, None, '(get scores) error, status code: '+str(response_0.status_code if response_0 is not None else None)
+    except AttributeError:
+        return pmid, None, '(get scores) AttributeError'
+    except requests.RequestException as e:
+        return pmid, None, '(get scores) {}'.format(type(e).__name__)
 
-    else:  
-        total_pages = (int(result_hitcount // 25)) + 1
 
-    for page in range(2,total_pages+1): #page one was already done so continue from page 2 and add results to same dictionary
+def hecatos_scorer(concurrency = 8, requests_per_second = 10):
+    '''Scorer for get_scores using the ChEMBL HeCaToS webservice at SCORE_URL (ChEMBL-likeness score).
+    A scorer is a function taking a list of (id, title, abstract) tuples and yielding (id, score, error_info) for each of them, error_info is None when there is a score.
+    The id is only passed through, get_scores uses a hash of the text.
+    It has a version attribute, a string that changes when the scores it gives change (e.g. a new model), see get_scores.
+    Here the abstracts are scored by a pool of worker threads, together sending at most requests_per_second requests per second.
+    kwargs: concurrency -- number of abstracts scored at the same time (default = 8)
+            requests_per_second -- maximum number of requests per second to the web service over all workers, None for no limit (default = 10)'''
+    
+    wait = _rate_limiter(requests_per_second)
+    
+    def score(item):
+        wait()
+        return _score_article(item)
+    
+    def scorer(items):
+        return _ordered_map(score, items, concurrency = concurrency)
+    
+    scorer.version = 'HeCaToS_ChEMBLLIKE'
+    
+    return scorer
 
-        tree = do_query(query, page_nr = page)
-        result_abstracts = tree.xpath('/responseWrapper/resultList/result')
 
-        for item in result_abstracts:
-            try:
-                pmid = int(item.xpath('pmid/text()')[0])
-                cursor.execute("insert or ignore into result_ids(query_id, pmid) values(?,?)", (current_query_id, pmid))
+_TOKEN_PATTERN = re.compile(r'[a-z][a-z0-9-]+')
 
-                if pmid in existing_pmid_list:
-                    #exist_count += 1
-                    continue
-                else:
-                    try:
-                        retrieve_data(item)
-                        #new_inserted_count += 1
-                    except IndexError:
-                        object_id = item.xpath('id/text()')[0]
-                        error_comment = '(get_pmids_and_article_data) - IndexError with XML, possibly field not present, e.g. no journal info e.g. when is book chapter'
-                        cursor.execute("insert or ignore into error_records(query_id, object_id, error_comment) values (?,?,?)", (current_query_id, object_id, error_comment))
-                        continue
-            except IndexError:
-                object_id = item.xpath('id/text()')[0]
-                error_comment = '(get_pmids_and_article_data) - IndexError with XML, possibly no pmid for this item or no journal info e.g. when is book chapter'
-                cursor.execute("insert or ignore into error_records(query_id, object_id, error_comment) values (?,?,?)", (current_query_id, object_id, error_comment))
-                continue
-            
-    conn.commit()
-    conn.close()
-    #print(new_inserted_count, exist_count)
+def _term_matrix(texts, vocabulary, add_terms = False):
+    '''Sparse matrix (scipy csr) with the counts of the terms of vocabulary (dict term -> column) in each of texts, one row per text. Other terms are ignored,
+    or with add_terms = True added to vocabulary.'''
     
-    return current_query_id
+    term_lists = [_TOKEN_PATTERN.findall(text.lower()) for text in texts]
+    
+    if add_terms:
+        for term in dict.fromkeys(chain.from_iterable(term_lists)):
+            vocabulary.setdefault(term, len(vocabulary))
+    
+    lengths = [len(terms) for terms in term_lists]
+    columns = np.fromiter(map(vocabulary.get, chain.from_iterable(term_lists), repeat(-1)), dtype = np.int64, count = sum(lengths))
+    
+    rows = np.repeat(np.arange(len(texts)), lengths)
+    known = columns >= 0
+    
+    matrix = scipy.sparse.csr_matrix((np.ones(known.sum(), dtype = np.float32), (rows[known], columns[known])), shape = (len(texts), len(vocabulary)))
+    
+    return matrix
 
 
-# In[9]:
+def train_local_scorer(db_name, min_df = 3, alpha = 1.0):
+    '''Train a local text classifier on the titles and abstracts in article_data, labelled by whether the pmid is in the chembl_pmids table
+    (so run pop_chembl_pmids first). It is a multinomial naive Bayes model on the word counts, done with numpy and scipy sparse matrices.
+    Returns a scorer for get_scores (see hecatos_scorer) that scores a whole list of abstracts with one matrix product. Its version is 'local-nb-' followed by a hash of the model,
+    so scores of the same model are reused and a retrained model that differs scores again. The score is the log-odds of being a ChEMBL-like article,
+    higher is more ChEMBL-like, so it ranks like the HeCaToS score but is on a different scale.
+    kwargs: db_name
+            min_df -- only words found in at least this number of abstracts are used (default = 3)
+            alpha -- smoothing added to the word counts of both classes (default = 1.0)'''
+    
+    conn = _connect(db_name)
+    cursor = conn.cursor()
+    
+    cursor.execute('''select a.title, a.abstract, c.pmid is not null from article_text a left join chembl_pmids c on a.pmid = c.pmid
+                    where a.title is not null and a.abstract is not null''')
+    results = cursor.fetchall()
+    conn.close()
+    
+    labels = np.array([label for title, abstract, label in results], dtype = bool)
+    
+    assert labels.any() and not labels.all(), "need abstracts both in and not in chembl_pmids to train on"
+    
+    all_terms = {}
+    matrix = _term_matrix([title + ' ' + abstract for title, abstract, label in results], all_terms, add_terms = True)
+    
+    # keep the words found in at least min_df abstracts
+    document_frequency = np.bincount(matrix.indices, minlength = matrix.shape[1])
+    keep = np.flatnonzero(document_frequency >= min_df)
+    matrix = matrix[:, keep]
+    
+    terms = np.array(list(all_terms), dtype = object)[keep]
+    vocabulary = {term: column for column, term in enumerate(terms)}
+    
+    positive_counts = np.asarray(matrix[labels].sum(axis = 0)).ravel() + alpha
+    negative_counts = np.asarray(matrix[~labels].sum(axis = 0)).ravel() + alpha
+    
+    weights = np.log(positive_counts / positive_counts.sum()) - np.log(negative_counts / negative_counts.sum())
+    bias = np.log(labels.mean()) - np.log(1 - labels.mean())
+    
+    print('trained on {} abstracts ({} in ChEMBL), {} words'.format(len(results), int(labels.sum()), len(vocabulary)))
+    
+    def scorer(items):
+        
+        items = list(items)
+        matrix = _term_matrix([title + ' ' + abstract for pmid, title, abstract in items], vocabulary)
+        scores = matrix.dot(weights) + bias
+        
+        return [(item[0], float(score), None) for item, score in zip(items, scores)]
+    
+    model_hash = hashlib.sha1('\n'.join(terms).encode('utf-8') + weights.tobytes() + np.float64(bias).tobytes()).hexdigest()
+    scorer.version = 'local-nb-' + model_hash[:12]
+    
+    return scorer
 
-def get_scores(query_id, db_name):
-    '''For given query_id rank corresponding titles and abstracts using ChEMBL HeCaToS webservice (ChEMBL-likeness score). 
-    Save in scores table. Excludes any pmids for which there is already a score in the scores table.
-    If no score could be retrieved, is saved in error table together with pmid and query_id
-    kwargs: query_id -- query_id from queries table, db_name'''
+
+def _text_hash(title, abstract):
+    '''Hash of title and abstract used as key of the score_cache table. Whitespace and capitals are normalized first, so the same text under a different pmid
+    (erratum, reprint) gets the same hash.'''
+    
+    text = ' '.join(title.lower().split()) + '\n' + ' '.join(abstract.lower().split())
     
-    title_abstract_dict = {}
-    URL = 'http://scitegic.windows.ebi.ac.uk:9955/rest/HeCaToS_ChEMBLLIKE/{}/{}'
-    score_dict = {}
-    #my_count = 0
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
 
-    conn = lite.connect(db_name)
+
+def get_scores(query_id, db_name, scorer = None, concurrency = 8, requests_per_second = 10, flush_every = 100):
+    '''For given query_id rank corresponding titles and abstracts using ChEMBL HeCaToS webservice (ChEMBL-likeness score), or another scorer.
+    Save in scores table. Excludes any pmids for which there is already a score of the same scorer version in the scores table.
+    If no score could be retrieved, is saved in error table together with pmid and query_id
+    By default the web service is used through hecatos_scorer with the concurrency and requests_per_second given here. A local model from train_local_scorer can be passed as scorer instead.
+    Every score is also kept in the score_cache table under a hash of the normalized title and abstract and the version of the scorer. Texts that are in there
+    are not scored again, also not when they are under another pmid, and every distinct text is only scored once. After changing scorer the pmids get the scores of the
+    new version, switching back reuses the cached ones. Cached scores of one version can be removed with invalidate_scores.
+    Scores and errors are written in one transaction per flush_every abstracts, so the scores done so far are kept when the run is interrupted and a rerun only does the rest.
+    Other processes can write to the db at the same time, a flush waits for them and is retried when the db stays locked.
+    kwargs: query_id -- query_id from queries table, db_name
+            scorer -- function taking a list of (id, title, abstract) and yielding (id, score, error_info), with a version attribute. None for hecatos_scorer (default = None)
+            concurrency -- number of abstracts scored at the same time by the web service (default = 8)
+            requests_per_second -- maximum number of requests per second to the web service over all workers, None for no limit (default = 10)
+            flush_every -- number of scored abstracts written to the db per transaction (default = 100)'''
+    
+    if scorer is None:
+        scorer = hecatos_scorer(concurrency = concurrency, requests_per_second = requests_per_second)
+    
+    scorer_version = getattr(scorer, 'version', getattr(scorer, '__name__', 'custom'))
+    
+    conn = _connect(db_name)
     cursor = conn.cursor()
     
-    cursor.execute('''select pmid, title, abstract from article_data 
+    cursor.execute('''select pmid, title, abstract from article_text 
                     where title is not null 
                     and abstract is not null 
-                    and pmid not in (select distinct pmid from scores) 
-                    and pmid in (select pmid from result_ids where query_id = ?) ''', (query_id,))
-    #this sql query excludes things that already have a score
+                    and pmid not in (select pmid from scores where scorer_version = ?) 
+                    and pmid in (select pmid from result_ids where query_id = ?) ''', (scorer_version, query_id))
+    #this sql query excludes things that already have a score of this scorer version
     
     results = cursor.fetchall()
     
-    for item in results:
-        pmid = item[0]
-        title = item[1]
-        abstract = item[2]
-        title_abstract_dict[pmid]= [title, abstract]
+    # group the pmids on their text, and look the texts up in the score cache
+    hash_pmids = {}
+    to_score = {}
     
-    for article_pmid in title_abstract_dict:
-        
-        try:
-            title = title_abstract_dict[article_pmid][0]
-            abstract = title_abstract_dict[article_pmid][1]
+    for article_pmid, title, abstract in results:
+        text_hash = _text_hash(title, abstract)
+        hash_pmids.setdefault(text_hash, []).append(article_pmid)
+        to_score.setdefault(text_hash, (text_hash, title, abstract))
+    
+    def cached_scores():
+        with conn:
+            conn.execute('create temp table if not exists score_hashes(text_hash text primary key)')
+            conn.execute('delete from score_hashes')
+            conn.executemany('insert into score_hashes(text_hash) values (?)', [(text_hash,) for text_hash in hash_pmids])
+            return conn.execute('''select c.text_hash, c.score from score_hashes h join score_cache c on c.text_hash = h.text_hash and c.scorer_version = ?''', (scorer_version,)).fetchall()
+    
+    cached_scores = _retry_locked(conn, cached_scores)
+    
+    def flush(score_rows, cache_rows, error_rows):
+        with conn:
+            conn.executemany("insert or replace into scores(pmid, score, scorer_version) values(?,?,?)", score_rows)
+            conn.executemany("insert or ignore into score_cache(text_hash, scorer_version, score) values(?,?,?)", cache_rows)
+            conn.executemany("insert or ignore into error_records(query_id, pmid, error_comment) values (?,?,?)", error_rows)
+        del score_rows[:], cache_rows[:], error_rows[:]
     
-            pre_title = str(base64.b64encode(title.encode('utf-8')))
-            post_title = re.search("^b'(.*)'$", pre_title).group(1)
+    score_rows = []
+    cache_rows = []
+    error_rows = []
     
-            pre_abstract = str(base64.b64encode(abstract.encode('utf-8')))
-            post_abstract = re.search("^b'(.*)'$", pre_abstract).group(1)
+    for text_hash, cl_score in cached_scores:
+        score_rows.extend((article_pmid, cl_score, scorer_version) for article_pmid in hash_pmids[text_hash])
+        del to_score[text_hash]
     
-            response_0 = requests.get(URL.format(post_title, post_abstract))
-            response = response_0.json()  
+    _retry_locked(conn, flush, score_rows, cache_rows, error_rows)
+    
+    print('{} abstracts to score, {} distinct texts of which {} found in the score cache'.format(len(results), len(hash_pmids), len(cached_scores)))
+    
+    # the scorer gets the text hash in place of the pmid, so every distinct text is scored once
+    try:
+        for text_hash, cl_score, error_info in scorer(list(to_score.values())):
             
-            cl_score = float(response['score'])
-            cursor.execute("insert or ignore into scores(pmid, score) values(?,?)", (article_pmid, cl_score))
-            #my_count += 1
+            if error_info is None:
+                score_rows.extend((article_pmid, cl_score, scorer_version) for article_pmid in hash_pmids[text_hash])
+                cache_rows.append((text_hash, scorer_version, cl_score))
+            else:
+                error_rows.extend((query_id, article_pmid, error_info) for article_pmid in hash_pmids[text_hash])
             
-        except ValueError:
-            error_info = '(get scores) error, status code: '+str(response_0.status_code)
-            cursor.execute("insert or ignore into error_records(query_id, pmid, error_comment) values (?,?,?)", (query_id, article_pmid, error_info))
-        except AttributeError:
-            error_info = '(get scores) AttributeError'
-            cursor.execute("insert or ignore into error_records(query_id, pmid, error_comment) values (?,?,?)", (query_id, article_pmid, error_info))
+            if len(cache_rows) + len(error_rows) >= flush_every:
+                _retry_locked(conn, flush, score_rows, cache_rows, error_rows)
+    finally:
+        _retry_locked(conn, flush, score_rows, cache_rows, error_rows)
+        conn.close()
+    
+    return None
+
+
+def invalidate_scores(db_name, scorer_version):
+    '''Remove the scores of one scorer version from the score_cache and scores tables, scores of other versions are kept.
+    The next get_scores with a scorer of this version scores the abstracts again.
+    kwargs: db_name
+            scorer_version -- version attribute of the scorer, e.g. 'HeCaToS_ChEMBLLIKE' '''
+    
+    conn = _connect(db_name)
+    
+    with conn:
+        removed_cache = conn.execute('delete from score_cache where scorer_version = ?', (scorer_version,)).rowcount
+        removed_scores = conn.execute('delete from scores where scorer_version = ?', (scorer_version,)).rowcount
     
-    conn.commit()
     conn.close()
-    #print(my_count)
+    
+    print('removed {} cached scores and {} pmid scores of version {}'.format(removed_cache, removed_scores, scorer_version))
+    
     return None
     
     
 
-
 # In[21]:
 
 def set_chembl_values(query_id, db_name):
-    '''This function updates the article_data table and sets the in_chembl field by comparing pmid with chembl_pmids table. Needs to be done for each query_id for the sorting in the get_df to work well.
+    '''This function updates the article_data table and sets the in_chembl field by comparing pmid with chembl_pmids table.
+    No longer needed: in_chembl is kept up to date for all articles by triggers on article_data and chembl_pmids (see _migration_1). Kept so existing notebooks still run,
+    it checks all articles in one pass and only writes the ones that differ, normally none.
     kwargs:
-            query_id
+            query_id -- not used anymore, all articles are checked
             db_name'''
     
-    conn = lite.connect(db_name)
-    cursor = conn.cursor()
+    conn = _connect(db_name)
     
-    cursor.execute('update article_data set in_chembl = 1 where pmid in (select pmid from result_ids where query_id = ?) and pmid in (select distinct pmid from chembl_pmids)', (query_id,))
-    cursor.execute('update article_data set in_chembl = 0 where pmid in (select pmid from result_ids where query_id = ?) and pmid not in (select distinct pmid from chembl_pmids)', (query_id,))
+    with conn:
+        _update_in_chembl(conn)
     
-    conn.commit()
     conn.close()
 
     return None
@@ -681,254 +1744,444 @@ def set_chembl_values(query_id, db_name):
 
 # In[11]:
 
-def get_availabilities(query_id, db_name):
+SFX_URL = 'http://wtgcsfx.hosted.exlibrisgroup.com/wtsc?sid=Entrez:PubMed&id=pmid:{}'
+SFX_RESOLVER_URL = 'http://wtgcsfx.hosted.exlibrisgroup.com/wtsc/cgi/core/sfxresolver.cgi'
+
+def _sfx_form_urls(tree, table_id):
+    '''Submit the hidden "basic" forms in the SFX service table table_id of the SFX page tree and return the urls of the responses with status code 200.
+    Raises requests.TooManyRedirects like the submission does.'''
+    
+    urls = []
+    
+    for form in tree.xpath('//table[@id="{}"]//form[contains(@name, "basic")]'.format(table_id)):
+        
+        params = {x.attrib['name']: x.attrib['value'] for x in form.xpath('.//input[@type="hidden"]')}
+        response = _http_get(SFX_RESOLVER_URL, params = params)
+        
+        if response.status_code == 200:
+            urls.append(response.url)
+    
+    return urls
+
+
+def _resolve_availability(pmid):
+    '''Resolve the campus access of one pmid with the SFX resolver: fetch the SFX page of the pmid and follow its forms.
+    Returns (pmid, field, value) with field 'campus_links' or 'request_access' and value the comma-joined urls, or field 'error' and value the error comment.
+    Field is None when nothing should be saved (connection problems), so the pmid is tried again in the next run.'''
+    
+    try:
+        
+        # retries with backoff are done by the shared session
+        response = _http_get(SFX_URL.format(pmid))
+        
+        if response.status_code != 200:
+            return pmid, 'error', "(get_availability) Case 5: could not get status code 200 from sfx page for this pmid after {} retries.".format(HTTP_RETRIES)
+        
+        tree = lxml.html.fromstring(response.text)
+        ft_avail = tree.xpath('//div[@class="service"]/text()')
+        
+        if 'No Full text available' in str(ft_avail):
+            
+            urls = _sfx_form_urls(tree, 'service_type_header_getDocumentDelivery')
+            
+            if not urls:
+                return pmid, 'error', '(get_availability) Case 1: No URL with status_code = 200 available.'
+            
+            return pmid, 'request_access', ', '.join(urls)
+        
+        if not ft_avail:
+            return pmid, 'error', '(get_availability) Case 2: ft_avail is empty. Not the usual SFX page, possibly SFX Multiple Object Menu, suggest to go to the page manually'
+        
+        if 'Request document via' in str(ft_avail):
+            
+            urls = _sfx_form_urls(tree, 'service_type_header_getFullTxt')
+            
+            if urls:
+                return pmid, 'campus_links', ', '.join(urls)
+            
+            urls = _sfx_form_urls(tree, 'service_type_header_getDocumentDelivery')
+            
+            if not urls:
+                return pmid, 'error', '(get_availability) Case 1b: No URL with status_code = 200 available.'
+            
+            return pmid, 'request_access', ', '.join(urls)
+        
+        return pmid, 'error', "(get_availability) Case 4: Could not resolve access for article strings that were tested were not present in response."
+    
+    except requests.TooManyRedirects:
+        print(pmid, ' -- TooManyRedirects')
+        return pmid, 'error', '(get_availability) TooManyRedirects'
+    except (TypeError, requests.ConnectionError, requests.Timeout):
+        print('oops, not going well there', pmid)
+        return pmid, None, None
+    except Exception:
+        print("Unexpected error:", sys.exc_info()[0], pmid)
+        return pmid, None, None
+
+
+def _inferred_access(counts, min_observations):
+    '''The access inferred from the (campus_count, request_count) of a (journal_title, year): 'campus_links' or 'request_access' when at least min_observations
+    pmids were resolved and all of them gave the same access, else None.'''
+    
+    campus_count, request_count = counts
+    
+    if campus_count >= min_observations and request_count == 0:
+        return 'campus_links'
+    if request_count >= min_observations and campus_count == 0:
+        return 'request_access'
+    
+    return None
+
+
+def get_availabilities(query_id, db_name, concurrency = 4, flush_every = 50, infer_access = True, min_observations = 3, verify_fraction = 0.1):
     '''Want to check access to paper via campus subscriptions for those without 'F' or 'OA' in the availability_codes OR those without any availability codes, of a given query. 
     Check whether the SFX resolver has link to Full Text available, if so, save link in campus_links field of the article_links table, else, save link to 'request document' form in request_access field in article_links table.
+    The links are also saved one per row in the article_urls table, with kind 'campus' or 'request_access'.
     Excludes articles already in ChEMBL. Also skips pubmed ids which have article data already retrieved.
+    The pmids are resolved by a pool of worker threads, each fetching the SFX page of a pmid and following its forms, so the page of one pmid is fetched while
+    the forms of others are followed. The number of connections to the SFX host is limited by its entry in HTTP_POOL_SIZES (see configure_http), retries of
+    failed and rate-limited (429) requests back off exponentially. Links and errors are written in one transaction per flush_every pmids, which waits for
+    other processes writing to the db and is retried when the db stays locked.
+    Campus access is nearly always the same for a journal in a year, so every resolved pmid is counted per (journal_title, year) in the access_inference table.
+    Once min_observations pmids of a journal and year all gave the same access, further pmids of it are not sent to SFX: the link to their SFX page is saved
+    in campus_links or request_access and the pmid is listed in inferred_links, get_df shows these as inferred links. A fraction verify_fraction of them is still resolved to check the inference,
+    a different outcome makes the journal and year uncertain again.
     kwargs: query_id -- query_id from queries table in queries_db
-            db_name -- name of SQLite database'''
+            db_name -- name of SQLite database
+            concurrency -- number of pmids resolved at the same time (default = 4)
+            flush_every -- number of resolved pmids written to the db per transaction (default = 50)
+            infer_access -- use the access_inference table to skip SFX for journals and years with a known access (default = True)
+            min_observations -- number of resolved pmids with the same access needed before a journal and year is inferred (default = 3)
+            verify_fraction -- fraction of the inferable pmids that is resolved anyway to verify the inference (default = 0.1)'''
     
-    conn = lite.connect(db_name)
+    conn = _connect(db_name)
     cursor = conn.cursor()
-    avail_dict = {}
+    current_date = datetime.date.today().strftime('%Y-%m-%d')
+    
+    sql =  '''select pmid, journal_title, year from article_data
+            where ((avail_codes not like '%F%' and avail_codes not like '%OA%') or avail_codes is null)
+            and pmid in (select pmid from result_ids where query_id = ?)
+            and not exists (select 1 from article_links al where al.pmid = article_data.pmid)
+            and in_chembl != 1'''
+    
+    cursor.execute(sql, (query_id,))
+    articles = cursor.fetchall()
+    journal_years = {pmid: (journal_title, year) for pmid, journal_title, year in articles}
+    
+    access_counts = {(journal_title, year): [campus_count, request_count] for journal_title, year, campus_count, request_count
+                     in cursor.execute('select journal_title, year, campus_count, request_count from access_inference')}
+    # counts of this run not yet written to access_inference, added to the counts in the table so runs in other processes are counted as well
+    count_increments = {}
+    verify_pmids = {}
+    
+    link_rows = []
+    url_rows = []
+    error_rows = []
+    inferred_rows = []
+    
+    def pmids_to_resolve():
+        # runs in this thread while the pool works, so the counts of pmids resolved so far are used
+        for pmid, journal_title, year in articles:
+            
+            key = (journal_title, year)
+            access = None
             
-    def f(form):
+            if infer_access and journal_title is not None and year is not None:
+                access = _inferred_access(access_counts.get(key, (0, 0)), min_observations)
+            
+            if access is None:
+                yield pmid
+            elif random.random() < verify_fraction:
+                verify_pmids[pmid] = access
+                yield pmid
+            else:
+                link = SFX_URL.format(pmid)
+                link_rows.append((pmid, link, None) if access == 'campus_links' else (pmid, None, link))
+                url_rows.extend(_link_url_rows(pmid, 'campus' if access == 'campus_links' else 'request_access', link))
+                inferred_rows.append((pmid, journal_title, year, current_date))
+    
+    def flush(link_rows, url_rows, error_rows, inferred_rows):
+        with conn:
+            conn.executemany('insert or ignore into article_links(pmid, campus_links, request_access) values (?,?,?)', link_rows)
+            conn.executemany('insert or ignore into article_urls(pmid, kind, ordinal, url, availability_code) values (?,?,?,?,?)', url_rows)
+            conn.executemany('insert or ignore into error_records(query_id, pmid, error_comment) values (?,?,?)', error_rows)
+            # a pmid resolved with SFX is no longer inferred, e.g. when its inferred link was deleted and get_availabilities was run again
+            inferred_pmids = {row[0] for row in inferred_rows}
+            conn.executemany('delete from inferred_links where pmid = ?', [(row[0],) for row in link_rows if row[0] not in inferred_pmids])
+            conn.executemany('insert or replace into inferred_links(pmid, journal_title, year, date_inferred) values (?,?,?,?)', inferred_rows)
+            conn.executemany('''insert into access_inference(journal_title, year, campus_count, request_count, date_updated) values (?,?,?,?,?)
+                                on conflict(journal_title, year) do update set campus_count = campus_count + excluded.campus_count,
+                                request_count = request_count + excluded.request_count, date_updated = excluded.date_updated''',
+                             [key + tuple(increment) + (current_date,) for key, increment in count_increments.items()])
+        del link_rows[:], url_rows[:], error_rows[:], inferred_rows[:]
+        count_increments.clear()
+    
+    resolved_count = 0
+    mismatch_count = 0
     
-        params = {x.attrib['name']: x.attrib['value'] for x in form.xpath('.//input[@type="hidden"]')}
+    try:
+        for pmid, field, value in _ordered_map(_resolve_availability, pmids_to_resolve(), concurrency = concurrency):
+            
+            resolved_count += 1
+            
+            if field == 'campus_links':
+                link_rows.append((pmid, value, None))
+                url_rows.extend(_link_url_rows(pmid, 'campus', value))
+            elif field == 'request_access':
+                link_rows.append((pmid, None, value))
+                url_rows.extend(_link_url_rows(pmid, 'request_access', value))
+            elif field == 'error':
+                error_rows.append((query_id, pmid, value))
+            
+            key = journal_years[pmid]
+            
+            if field in ('campus_links', 'request_access') and None not in key:
+                column = 0 if field == 'campus_links' else 1
+                access_counts.setdefault(key, [0, 0])[column] += 1
+                count_increments.setdefault(key, [0, 0])[column] += 1
+                if pmid in verify_pmids and verify_pmids[pmid] != field:
+                    mismatch_count += 1
+            
+            if len(link_rows) + len(error_rows) >= flush_every:
+                _retry_locked(conn, flush, link_rows, url_rows, error_rows, inferred_rows)
+    finally:
+        _retry_locked(conn, flush, link_rows, url_rows, error_rows, inferred_rows)
+        conn.close()
+    
+    print('{} pmids: {} resolved with SFX ({} to verify an inference, {} of those differed), {} inferred from journal and year'.format(
+          len(articles), resolved_count, len(verify_pmids), mismatch_count, len(articles) - resolved_count))
+            
+    return None
     
-        response = requests.get('http://wtgcsfx.hosted.exlibrisgroup.com/wtsc/cgi/core/sfxresolver.cgi', params=params)
     
-        return response.status_code, response.url    
     
     
-    sql =  '''select pmid from article_data
-            where ((avail_codes not like '%F%' and avail_codes not like '%OA%') or avail_codes is null)
-            and pmid in (select pmid from result_ids where query_id = ?)
-            and pmid not in (select distinct pmid from article_links)
-            and in_chembl != 1'''
     
-    cursor.execute(sql, (query_id,))
-   
-    for pmid in [i[0] for i in cursor.fetchall()]:
-        
-        try:
-        
-            for attempt_number in range(3):
-
-                response = requests.get('http://wtgcsfx.hosted.exlibrisgroup.com/wtsc?sid=Entrez:PubMed&id=pmid:{}'.format(pmid))
-
-                if response.status_code == 200:
-                    tree = lxml.html.fromstring(response.text)
-                    ft_avail = tree.xpath('//div[@class="service"]/text()')
-                    break
-
-                else:
-                    sleep(2)
-                    continue
-
-
-            if response.status_code == 200:
-
-                if 'No Full text available' in str(ft_avail):
-
-                    try:
-                        #raise requests.TooManyRedirects('oh no')
-                        responses = [f(x) for x in tree.xpath('//table[@id="service_type_header_getDocumentDelivery"]//form[contains(@name, "basic")]')]
-
-                        urls = [response_tuple[1] for response_tuple in responses if response_tuple[0] == 200]
-
-                        if not urls:
-                            error_info = '(get_availability) Case 1: No URL with status_code = 200 available.'
-                            cursor.execute("insert or ignore into error_records(query_id, pmid, error_comment) values (?,?,?)", (query_id, pmid, error_info))
-                            continue
-
-                        else:
-                            urls_string = ', '.join(urls)
-                            cursor.execute('insert into article_links(pmid, request_access) values(?,?)', (pmid, urls_string))
-                            conn.commit()
-                            continue
-
-                    except requests.TooManyRedirects:
-                        print(pmid, ' -- TooManyRedirects')
-                        error_info = '(get_availability) TooManyRedirects'
-                        cursor.execute("insert or ignore into error_records(query_id, pmid, error_comment) values (?,?,?)", (query_id, pmid, error_info))
-                        conn.commit()
-                        continue
-
-                if not ft_avail:
-                    error_info = '(get_availability) Case 2: ft_avail is empty. Not the usual SFX page, possibly SFX Multiple Object Menu, suggest to go to the page manually'
-                    cursor.execute("insert or ignore into error_records(query_id, pmid, error_comment) values(?,?,?)", (query_id, pmid, error_info))
-                    continue
-
-                if ('No Full text available' not in str(ft_avail) and 'Request document via' in str(ft_avail)):
-
-                    try:
-                        #raise requests.TooManyRedirects('oh no')
-                        responses = [f(x) for x in tree.xpath('//table[@id="service_type_header_getFullTxt"]//form[contains(@name, "basic")]')]
-
-                        urls = [response_tuple[1] for response_tuple in responses if response_tuple[0] == 200]
-
-                        if not urls:
-
-                            try:
-                                responses = [f(x) for x in tree.xpath('//table[@id="service_type_header_getDocumentDelivery"]//form[contains(@name, "basic")]')]
-                                urls = [response_tuple[1] for response_tuple in responses if response_tuple[0] == 200]
-
-                                if not urls:
-                                    error_info = '(get_availability) Case 1b: No URL with status_code = 200 available.'
-                                    cursor.execute("insert or ignore into error_records(query_id, pmid, error_comment) values (?,?,?)", (query_id, pmid, error_info))
-                                    continue
-
-                                else:
-                                    urls_string = ', '.join(urls)
-                                    cursor.execute('insert into article_links(request_access, pmid) values(?,?)', (urls_string, pmid))
-                                    conn.commit()
-                                    continue
-
-                            except requests.TooManyRedirects:
-                                #print(pmid, ' -- TooManyRedirects')
-                                error_info = '(get_availability) TooManyRedirects'
-                                cursor.execute("insert or ignore into error_records(query_id, pmid, error_comment) values (?,?,?)", (query_id, pmid, error_info))
-                                conn.commit()
-                                continue
-
-                            #error_info = '(get_availability) Case 3: No campus ft-URL with status_code = 200 available.'
-                            #cursor.execute("insert or ignore into other_error(query_id, pmid, error_comment) values (?,?,?)", (query_id, pmid, error_info))
-                            #continue
-
-                        else:
-                            urls_string = ', '.join(urls)
-                            cursor.execute('insert into article_links(campus_links, pmid) values (?,?)', (urls_string, pmid))
-                            conn.commit()
-                            continue
 
-                    except requests.TooManyRedirects:
-                        error_info = '(get_availability) TooManyRedirects'
-                        cursor.execute("insert or ignore into error_records(query_id, pmid, error_comment) values (?,?,?)", (query_id, pmid, error_info))
-                        conn.commit()
-                        continues
 
+# In[ ]:
 
-                else:
-                    error_info = "(get_availability) Case 4: Could not resolve access for article strings that were tested were not present in response."
-                    cursor.execute('insert or ignore into error_records(query_id, pmid, error_comment) values (?,?,?)', (query_id, pmid, error_info))
-                    continue
+_EPMC_QUERY_TOKEN = re.compile(r'\s*(?:(\()|(\))|(?:([A-Za-z_]+):\s*)?(?:(\()|"([^"]*)"|([^\s()"]+)))')
+_FTS_COLUMNS = {'ABSTRACT': 'abstract', 'TITLE': 'title', 'TITLE_ABS': '{title abstract}'}
 
+def _fts_expression(expr):
+    '''Translate an ePMC query such as the ones from define_synonym_queries, e.g. (ABSTRACT:"calcium channel" OR ABSTRACT:"LTCC") AND (ABSTRACT:"QSAR"),
+    into an FTS5 expression over the article_fts columns. Terms can be phrases in double quotes or single words, with an optional * at the end for a prefix search
+    (also inside the quotes, ABSTRACT:"cardiac*"), with field ABSTRACT, TITLE or TITLE_ABS, or no field for title and abstract. A field can also be put before a bracket,
+    ABSTRACT:(a OR b), and then applies to all terms in it. AND, OR, NOT (also AND NOT) and brackets are kept.
+    FTS5 only has NOT between two terms, so a NOT at the start of the query or of a bracket, or after OR, raises ValueError.
+    Raises ValueError for other fields (e.g. src:MED or dates), for a : that does not follow a field name and for text that can not be read.'''
+    
+    parts = []
+    position = 0
+    expr = expr.strip()
+    
+    while position < len(expr):
+        
+        match = _EPMC_QUERY_TOKEN.match(expr, position)
+        
+        if match is None or match.end() == position:
+            raise ValueError('can not read the query at: {}'.format(expr[position:]))
+        
+        position = match.end()
+        open_bracket, close_bracket, field, field_bracket, phrase, word = match.groups()
+        
+        if field is not None and field.upper() not in _FTS_COLUMNS:
+            raise ValueError('field {} can not be searched in the cache, only {}'.format(field, ', '.join(_FTS_COLUMNS)))
+        
+        if open_bracket or close_bracket:
+            parts.append(open_bracket or close_bracket)
+        
+        elif field_bracket:
+            parts.extend(['{} :'.format(_FTS_COLUMNS[field.upper()]), '('])
+        
+        elif field is None and phrase is None and word in ('AND', 'OR', 'NOT'):
+            if word == 'NOT' and parts and parts[-1] == 'AND':
+                parts[-1] = 'NOT'
+            elif word == 'NOT' and (not parts or parts[-1] in ('(', 'OR', 'NOT')):
+                raise ValueError('NOT without a term before it can not be searched in the cache: {}'.format(expr))
             else:
-                error_info = "(get_availability) Case 5: could not get status code 200 from sfx page for this pmid after 3 attempts."
-                cursor.execute('insert or ignore into error_records(query_id, pmid, error_comment) values (?,?,?)', (query_id, pmid, error_info))
-                continue
+                parts.append(word)
         
-        except (TypeError, requests.ConnectionError):
-            print('oops, not going well there', pmid)
-            continue
-        except:
-            print("Unexpected error:", sys.exc_info()[0], pmid)
-            continue
+        else:
+            if phrase is None and ':' in word:
+                raise ValueError('can not read the query at: {}'.format(word))
             
-    conn.commit()
-    conn.close()
+            if phrase is None:
+                phrase = word
             
-    return None
+            prefix = ' *' if phrase.endswith('*') else ''
+            phrase = phrase.rstrip('*')
+            
+            term = '"{}"{}'.format(phrase.replace('"', '""'), prefix)
+            
+            if field is not None:
+                term = '{} : {}'.format(_FTS_COLUMNS[field.upper()], term)
+            
+            parts.append(term)
+    
+    return ' '.join(parts)
+
+
+def search_cache(expr, db_name, query_id_list = None):
+    '''Search the titles and abstracts already in the db with the full text index, instead of running a new query on ePMC. Takes the same boolean
+    ABSTRACT:"..." syntax as made by define_synonym_queries (see _fts_expression), so a query can be refined on the articles of earlier harvests.
+    Matching is on words as in ePMC, without its synonym expansion, so the hits can differ a bit from ePMC.
+    Returns a pandas dataframe with columns pmid, year, title, journal_title and in_chembl, best matches first.
+    kwargs: expr -- query string, e.g. from define_synonym_queries
+            db_name -- name of SQLite database
+            query_id_list -- only search the articles of these query_ids, None for all articles (default = None)'''
     
+    conn = _connect(db_name)
     
+    assert conn.execute("select count(*) from sqlite_master where name = 'article_fts'").fetchone()[0], "no full text index in this db, SQLite without FTS5?"
     
+    sql = '''select a.pmid, a.year, a.title, a.journal_title, a.in_chembl from article_fts f
+             join article_text a on a.pmid = f.rowid
+             where article_fts match ?'''
+    params = [_fts_expression(expr)]
     
+    if query_id_list is not None:
+        sql += ' and a.pmid in (select r.pmid from result_ids r where r.query_id in ({}))'.format(', '.join('?' * len(query_id_list)))
+        params += list(query_id_list)
     
+    hits_df = pd.read_sql(sql + ' order by f.rank', conn, params = params)
+    conn.close()
+    
+    return hits_df
 
 
 # In[20]:
 
-def get_df(query_id_list, db_name, sql_condition = None):
-    '''Makes a dataframe for a given query/queries. Can include multiple query_ids from queries table. If only one is needed put that one item in a list. 
-    Selects following information on results for a given query from the queries_db: pmid, year, title, abstract, in_chembl, score, availability_codes, pdf_links, campus_links, request_access.
-    Then sort the dataframe. First sorts on in_chembl, availability (subscription without access last), then on scores. Campus_links are only displayed if full text available from subscription.
-    At the end of the dataframe the abstracts that had an error are displayed with an error_comment. The error_comment lists the function when the error occurred.
-    Returns a tuple with first a non-HTML data frame and second an HTML version of the dataframe. Save the non-HTML version for use in the colour_terms function.
-    It is possible to add further condition(s) to the sql statement by using the sql_condition argument. One "and" will be inserted by the function, then can add e.g. 's.score > 10', 
-    which will then be appended to the sql statement.
-    kwargs: query_id_list - list of query_ids to be included.
+def get_article_urls(query_id_list, db_name, kinds = None):
+    '''Get the links of the articles of the given queries from the article_urls table, one link per row.
+    Returns a pandas dataframe with columns pmid, kind ('pdf', 'other', 'campus' or 'request_access'), ordinal, url and availability_code, sorted on pmid, kind and ordinal.
+    kwargs: query_id_list -- list of query_ids to be included
             db_name -- name of SQLite database
-            sql_condition -- a further condition to be appended to the sql statement. One 'and' will be included by the function, so write the condition straight away. Default = None'''
-        
-    conn = lite.connect(db_name)
-    cursor = conn.cursor()
-    pd.set_option('max_colwidth',100000)
+            kinds -- list of the kinds of links to get, None for all (default = None)'''
+    
+    conn = _connect(db_name)
+    
+    sql = '''select u.pmid, u.kind, u.ordinal, u.url, u.availability_code from article_urls u
+             where u.pmid in (select r.pmid from result_ids r where r.query_id in ({}))'''.format(', '.join('?' * len(query_id_list)))
+    params = list(query_id_list)
+    
+    if kinds is not None:
+        sql += ' and u.kind in ({})'.format(', '.join('?' * len(kinds)))
+        params += list(kinds)
     
-    sql = '''select distinct r.pmid, a.year, a.title, a.abstract, a.journal_title, a.in_chembl, s.score, a.avail_codes, a.pdf_links, a.other_links, al.campus_links, al.request_access, er.error_comment
+    url_df = pd.read_sql(sql + ' order by u.pmid, u.kind, u.ordinal', conn, params = params)
+    conn.close()
+    
+    return url_df
+
+
+# columns of the report dataframes of get_df and separate_column_df, in the order of _REPORT_SQL
+_REPORT_COLUMNS = ['pmid', 'year', 'title', 'abstract', 'journal', 'inChEMBL', 'score', 'avail', 'pdf_links', 'other_links', 'campus_links', 'request_access', 'access_inferred', 'error_comment']
+
+# no distinct here: a select distinct can not be flattened with the article_text view on the right of a left join, and then SQLite decompresses the whole
+# article_data table for every report. The rows of a pmid can only differ in error_comment, duplicates are dropped on those two columns instead
+_REPORT_SQL = '''select r.pmid, a.year, a.title, a.abstract, a.journal_title, a.in_chembl, s.score, a.avail_codes, a.pdf_links, a.other_links, al.campus_links, al.request_access, il.pmid is not null, er.error_comment
         from result_ids r
-        left join article_data a on r.pmid = a.pmid
-        left join scores s on a.pmid = s.pmid
+        left join article_text a on r.pmid = a.pmid
+        left join scores s on (a.pmid = s.pmid and s.scorer_version = ?)
         left join article_links al on a.pmid = al.pmid
+        left join inferred_links il on al.pmid = il.pmid
         left join error_records er on (r.query_id = er.query_id and r.pmid = er.pmid)
         where r.query_id in ({})
         '''
+
+# sort of the report: not in ChEMBL first, then articles without errors, without request access links, highest score and with most kinds of links,
+# and an access resolved with SFX before one inferred from the journal and year (see get_availabilities)
+_REPORT_SORT_COLUMNS = ['inChEMBL', 'error_comment', 'request_access_boolean', 'score', 'pdf_links_boolean', 'other_links_boolean', 'campus_links_boolean', 'access_inferred']
+_REPORT_SORT_ASCENDING = [True, True, True, False, False, False, False, True]
+
+def _link_html(links, link_type):
+    '''Turn a column of joined links ('link, link, ...') into HTML anchors named <link_type>_link_<n>, joined with ', ' again. Rows without links get ''.
+    Done per link position (pdf_links rarely has more than a few links) with pandas string operations instead of per row.'''
+    
+    html = pd.Series('', index = links.index, dtype = object)
+    present = links.notna() & (links != '')
+    
+    if present.any():
+        parts = links[present].str.split(', ', expand = True)
+        joined = None
+        for number in parts.columns:
+            anchor = '<a target="_blank" href="' + parts[number] + '">{}_link_{}</a>'.format(link_type, number)
+            joined = anchor if joined is None else joined.where(parts[number].isna(), joined + ', ' + anchor)
+        html[present] = joined
+    
+    return html
+
+
+def _report_df(conn, query_id_list, sql_condition = None, scorer_version = 'HeCaToS_ChEMBLLIKE'):
+    '''The dataframe of get_df, with the scores of scorer_version: the links made into HTML anchors, a 0/1 column <links>_boolean per kind of link, '' for missing availability codes
+    and error comments and a pmid_link column with the link to PubMed. A campus or request access link that get_availabilities inferred from the journal and year
+    instead of resolving it with SFX is named <link_type>_inferred_link_<n> and has access_inferred 1. Sorted on _REPORT_SORT_COLUMNS, rows with the same values stay in the order of the SQL query.
+    Indexed from 1.'''
+    
+    sql = _REPORT_SQL.format(', '.join('?' * len(query_id_list)))
     
     if sql_condition != None:
         sql = sql+' and '+sql_condition
     
+    df = pd.read_sql(sql, conn, params = [scorer_version] + list(query_id_list))
+    df.columns = _REPORT_COLUMNS
+    df = df.drop_duplicates(subset = ['pmid', 'error_comment'])
     
-    def make_into_links(x, link_type):
-        if x:
-            link_list = x.split(', ')
-            new_link_list = []
-            if link_list:
-                for index,i in enumerate(link_list):
-                    item = '<a target="_blank" href="{}">{}_link_{}</a>'.format(i, link_type, index)
-                    new_link_list.append(item)
-            return ', '.join(new_link_list)
+    inferred = df['access_inferred'] == 1
     
-    sql_result_list = []
+    for column, link_type in [('pdf_links', 'pdf'), ('other_links', 'other'), ('campus_links', 'campus'), ('request_access', 'request_access')]:
+        html = _link_html(df[column], link_type)
+        if column in ('campus_links', 'request_access') and inferred.any():
+            html = html.where(~inferred, _link_html(df[column], link_type + '_inferred'))
+        df[column] = html
+        df[column + '_boolean'] = (df[column] != '').astype(int)
     
-    query_id = str(query_id_list).strip('[]')
-        
-    for row in cursor.execute(sql.format(query_id)):
-        sql_result_list.append(row)
+    df['avail'] = df['avail'].fillna('')
+    df['error_comment'] = df['error_comment'].fillna('')
     
-                              
-    try:
-        df = pd.DataFrame(sql_result_list, columns = ['pmid', 'year', 'title', 'abstract', 'journal', 'inChEMBL', 'score', 'avail', 'pdf_links', 'other_links', 'campus_links', 'request_access', 'error_comment'])
+    pmid = df['pmid'].astype(str)
+    df['pmid_link'] = '<a target="_blank" href="http://www.ncbi.nlm.nih.gov/pubmed/?term=' + pmid + '">' + pmid + '</a>'
+    
+    # missing inChEMBL and score go last, also for the descending sort on score
+    df = df.sort_values(_REPORT_SORT_COLUMNS, ascending = _REPORT_SORT_ASCENDING, kind = 'stable', na_position = 'last')
+    df.index = range(1,len(df) + 1)
+    
+    return df
 
-        df['ePMC_link'] = df['pmid'].apply(lambda x: '<a target="_blank" href="http://europepmc.org/abstract/MED/{}">ePMC link</a>'.format(x))
-        
-        df['pdf_links'] = df['pdf_links'].apply(make_into_links, link_type = 'pdf')
-        df['pdf_links_boolean'] = df['pdf_links'].apply(lambda x: 1 if x else 0)
-        df['pdf_links'] = df['pdf_links'].apply(lambda x: x if x else '')
-        
-        df['other_links'] = df['other_links'].apply(make_into_links, link_type = 'other')
-        df['other_links_boolean'] = df['other_links'].apply(lambda x: 1 if x else 0)
-        df['other_links'] = df['other_links'].apply(lambda x: x if x else '')
-        
-        df['campus_links'] = df['campus_links'].apply(make_into_links, link_type = 'campus')
-        df['campus_links_boolean'] = df['campus_links'].apply(lambda x: 1 if x else 0)
-        df['campus_links'] = df['campus_links'].apply(lambda x: x if x else '')
-        
-        df['request_access'] = df['request_access'].apply(make_into_links, link_type = 'request_access')
-        df['request_access_boolean'] = df['request_access'].apply(lambda x: 1 if x else 0)
-        df['request_access'] = df['request_access'].apply(lambda x: x if x else '')
-        
-        df['avail'] = df['avail'].apply(lambda x: x if x else '')
-        
-        df['error_comment'] = df['error_comment'].apply(lambda x: x if x else '')
-        
-        df['pmid_link'] = df['pmid'].apply(lambda x: '<a target="_blank" href="http://www.ncbi.nlm.nih.gov/pubmed/?term={}">{}</a>'.format(x,x))
-                                              
-        #df = df.convert_objects(convert_numeric=True)
 
-        df.sort(columns = ['inChEMBL', 'error_comment', 'request_access_boolean', 'score', 'pdf_links_boolean', 'other_links_boolean', 'campus_links_boolean'], ascending = [True, True, True, False, False, False, False], inplace = True)
-        df.index = range(1,len(df) + 1)
+def get_df(query_id_list, db_name, sql_condition = None, scorer_version = 'HeCaToS_ChEMBLLIKE'):
+    '''Makes a dataframe for a given query/queries. Can include multiple query_ids from queries table. If only one is needed put that one item in a list. 
+    Selects following information on results for a given query from the queries_db: pmid, year, title, abstract, in_chembl, score, availability_codes, pdf_links, campus_links, request_access.
+    Then sort the dataframe. First sorts on in_chembl, availability (subscription without access last), then on scores. Campus_links are only displayed if full text available from subscription.
+    Campus and request access links inferred from the journal and year by get_availabilities are named campus_inferred_link / request_access_inferred_link and have
+    access_inferred 1, they are the link to the SFX page of the article and were not checked with SFX.
+    At the end of the dataframe the abstracts that had an error are displayed with an error_comment. The error_comment lists the function when the error occurred.
+    Returns a tuple with first a non-HTML data frame and second an HTML version of the dataframe. Save the non-HTML version for use in the colour_terms function.
+    It is possible to add further condition(s) to the sql statement by using the sql_condition argument. One "and" will be inserted by the function, then can add e.g. 's.score > 10', 
+    which will then be appended to the sql statement. The tables can be referred to as r (result_ids), a (article data), s (scores), al (article_links), il (inferred_links) and er (error_records).
+    The links are made and the dataframe is sorted with pandas operations on whole columns, see benchmark_get_df in benchmark_common_functions_cache.py.
+    kwargs: query_id_list - list of query_ids to be included.
+            db_name -- name of SQLite database
+            sql_condition -- a further condition to be appended to the sql statement. One 'and' will be included by the function, so write the condition straight away. Default = None
+            scorer_version -- version of the scorer whose scores are shown and sorted on, see get_scores (default = 'HeCaToS_ChEMBLLIKE')'''
         
-        df = df.loc[:,['pmid', 'pmid_link', 'year', 'title', 'abstract', 'journal', 'inChEMBL', 'score', 'avail', 'pdf_links', 'other_links', 'campus_links', 'request_access', 'error_comment']]
-
-        conn.close()
+    conn = _connect(db_name)
+    pd.set_option('max_colwidth',100000)
     
+    try:
+        df = _report_df(conn, query_id_list, sql_condition, scorer_version)
+        df = df.loc[:,['pmid', 'pmid_link', 'year', 'title', 'abstract', 'journal', 'inChEMBL', 'score', 'avail', 'pdf_links', 'other_links', 'campus_links', 'request_access', 'access_inferred', 'error_comment']]
+        
         return df, HTML(df.to_html(escape=False))
-
+    
     except ValueError as e:
         print(e)
         print('probably no results for this query, empty db table or problem with df e.g. sorting')
-
     
+    finally:
+        conn.close()
 
 
 # In[1]:
@@ -962,157 +2215,75 @@ def colour_terms(df, markup_list):
 
 # In[22]:
 
-def separate_column_df(query_id_list, db_name, sql_condition = None):
+def _link_columns(links, prefix):
+    '''Split a column of joined link anchors into one column per link, <prefix>0, <prefix>1, ..., in one split. Rows with fewer links get '' in the
+    last columns, there is always at least the column <prefix>0.'''
+    
+    columns = links.str.split(', ', expand = True)
+    
+    if len(columns.columns) == 0:
+        columns = pd.DataFrame({0: pd.Series('', index = links.index, dtype = object)})
+    
+    columns = columns.fillna('')
+    columns.columns = [prefix + str(number) for number in columns.columns]
+    
+    return columns
+
+
+def separate_column_df(query_id_list, db_name, sql_condition = None, scorer_version = 'HeCaToS_ChEMBLLIKE'):
     '''Same as get_df function only now pdf_links and other_links have been split up in separate column for each link.
     Get_df docstring: Selects following information on results for a given query from the queries_db: pmid, year, title, abstract, in_chembl, score, availability_codes, pdf_links, campus_links, request_access.
     Then sort the dataframe. First sorts on in_chembl, availability (subscription without access last), then on scores. Campus_links are only displayed if full text available from subscription.
     At the end of the dataframe the abstracts that had an error are displayed with an error_comment. The error_comment lists the function when the error occurred.
     It is possible to add further condition(s) to the sql statement by using the sql_condition argument. One "and" will be inserted by the function, then can add e.g. 's.score > 10', 
     which will then be appended to the sql statement.
+    The link columns pdf-0, pdf-1, ... and other-0, other-1, ... (as many as the article with the most links has) are made with one split of the whole column.
     Returns a tuple with first a non_HTML data frame and second an HTML version of the dataframe.
     kwargs: query_id_list -- query_id from queries table in queries_db
             db_name -- Name of SQLite database
-            sql_condition -- a further condition to be appended to the sql statement. One 'and' will be included by the function, so write the condition straight away. Default = None'''
+            sql_condition -- a further condition to be appended to the sql statement. One 'and' will be included by the function, so write the condition straight away. Default = None
+            scorer_version -- version of the scorer whose scores are shown and sorted on, see get_scores (default = 'HeCaToS_ChEMBLLIKE')'''
     
-    conn = lite.connect(db_name)
-    cursor = conn.cursor()
+    conn = _connect(db_name)
     pd.set_option('max_colwidth',100000)
     
-    sql = '''select distinct r.pmid, a.year, a.title, a.abstract, a.journal_title, a.in_chembl, s.score, a.avail_codes, a.pdf_links, a.other_links, al.campus_links, al.request_access, er.error_comment
-        from result_ids r
-        left join article_data a on r.pmid = a.pmid
-        left join scores s on a.pmid = s.pmid
-        left join article_links al on a.pmid = al.pmid
-        left join error_records er on (r.query_id = er.query_id and r.pmid = er.pmid)
-        where r.query_id in ({})
-        '''
-    
-    if sql_condition != None:
-        sql = sql+' and '+sql_condition
-    
-    def make_into_links(x, link_type):
-        if x:
-            link_list = x.split(', ')
-            new_link_list = []
-            if link_list:
-                for index,i in enumerate(link_list):
-                    item = '<a target="_blank" href="{}">{}_link_{}</a>'.format(i, link_type, index)
-                    new_link_list.append(item)
-            return ', '.join(new_link_list)
-    
-    sql_result_list = []
-    
-    query_id = str(query_id_list).strip('[]')
-    
-    for row in cursor.execute(sql.format(query_id)):
-        sql_result_list.append(row)
-    
     try:
-        df = pd.DataFrame(sql_result_list, columns = ['pmid', 'year', 'title', 'abstract', 'journal', 'inChEMBL', 'score', 'avail', 'pdf_links', 'other_links', 'campus_links', 'request_access', 'error_comment'])
-
-        df['ePMC_link'] = df['pmid'].apply(lambda x: '<a target="_blank" href="http://europepmc.org/abstract/MED/{}">ePMC link</a>'.format(x))
-        
-        df['pdf_links'] = df['pdf_links'].apply(make_into_links, link_type = 'pdf')
-        df['pdf_links_boolean'] = df['pdf_links'].apply(lambda x: 1 if x else 0)
-        df['pdf_links'] = df['pdf_links'].apply(lambda x: x if x else '')
-        
-        df['other_links'] = df['other_links'].apply(make_into_links, link_type = 'other')
-        df['other_links_boolean'] = df['other_links'].apply(lambda x: 1 if x else 0)
-        df['other_links'] = df['other_links'].apply(lambda x: x if x else '')
-        
-        df['campus_links'] = df['campus_links'].apply(make_into_links, link_type = 'campus')
-        df['campus_links_boolean'] = df['campus_links'].apply(lambda x: 1 if x else 0)
-        df['campus_links'] = df['campus_links'].apply(lambda x: x if x else '')
-        
-        df['request_access'] = df['request_access'].apply(make_into_links, link_type = 'request_access')
-        df['request_access_boolean'] = df['request_access'].apply(lambda x: 1 if x else 0)
-        df['request_access'] = df['request_access'].apply(lambda x: x if x else '')
-        
-        df['avail'] = df['avail'].apply(lambda x: x if x else '')
-        
-        df['error_comment'] = df['error_comment'].apply(lambda x: x if x else '')
-        
-        df['pmid'] = df['pmid'].apply(lambda x: '<a target="_blank" href="http://www.ncbi.nlm.nih.gov/pubmed/?term={}">{}</a>'.format(x,x))
-                                              
-        #df = df.convert_objects(convert_numeric=True)
-
-        df.sort(columns = ['inChEMBL', 'error_comment', 'request_access_boolean', 'score', 'pdf_links_boolean', 'other_links_boolean', 'campus_links_boolean'], ascending = [True, True, True, False, False, False, False], inplace = True)
-        df.index = range(1,len(df) + 1)
-        
-        # get highest number of pdf links in the table
-        pdf_links_lengths_list = []
-        df['pdf_links'].apply(lambda x: pdf_links_lengths_list.append(len(x.split(', '))))
-
-        # insert each pdf link into separate column
-        for number in range(0,max(pdf_links_lengths_list)):
-            column_name = 'pdf-'+str(number)
-            df = pd.concat([df, df['pdf_links'].apply(lambda x: pd.Series({column_name:x.split(', ')[number] if (len(x.split(', ')) > number) else ''}))], axis = 1)
-    
-        # get names of columns that were added to the table
-        pdf_link_columns = []
-        for i in df.columns:
-            if 'pdf-' in i:
-                pdf_link_columns.append(i)
-            
-        # repeat process done on pdf_links on other_links
-        
-        
-        # get highest number of pdf links in the table
-        other_links_lengths_list = []
-        df['other_links'].apply(lambda x: other_links_lengths_list.append(len(x.split(', '))))
-
-        # insert each other link into separate column
-        for number in range(0,max(other_links_lengths_list)):
-            column_name = 'other-'+str(number)
-            df = pd.concat([df, df['other_links'].apply(lambda x: pd.Series({column_name:x.split(', ')[number] if (len(x.split(', ')) > number) else ''}))], axis = 1)
-    
-        # get names of columns that were added to the table
-        other_link_columns = []
-        for i in df.columns:
-            if 'other-' in i:
-                other_link_columns.append(i)
+        df = _report_df(conn, query_id_list, sql_condition, scorer_version)
+        df['pmid'] = df['pmid_link']
         
+        # insert each pdf link and each other link into separate column
+        df = pd.concat([df.loc[:,['pmid', 'year', 'title', 'abstract', 'journal', 'inChEMBL', 'score', 'avail', 'pdf_links_boolean']],
+                        _link_columns(df['pdf_links'], 'pdf-'), _link_columns(df['other_links'], 'other-'),
+                        df.loc[:,['campus_links', 'request_access', 'access_inferred', 'error_comment']]], axis = 1)
         
-        #subset dataframe to get relevant columns only
+        print(list(df.columns))
         
-        column_list = ['pmid', 'year', 'title', 'abstract', 'journal', 'inChEMBL', 'score', 'avail', 'pdf_links_boolean']
-        
-        for item in pdf_link_columns:
-            column_list.append(item)
-        
-        for item in other_link_columns:
-            column_list.append(item)
-            
-        for item in "campus_links, request_access, error_comment".split(', '):
-            column_list.append(item)
-        
-        print(column_list)
-        df = df.loc[:,column_list]
-
-        conn.close()
-    
         return df, HTML(df.to_html(escape=False))
-
+    
     except ValueError as e:
         print(e)
         print('probably no results for this query, empty db table or problem with df e.g. sorting')
+    
+    finally:
+        conn.close()
 
 
 # In[2]:
 
-def plot_scores(query_id_list, db_name, figure_title):
+def plot_scores(query_id_list, db_name, figure_title, scorer_version = 'HeCaToS_ChEMBLLIKE'):
     '''Creates a histogram of the chembl-likeness-scores for a given query/queries. Will plot inline.
     kwargs: query_id_list
             db_name
-            figure_title'''
+            figure_title
+            scorer_version -- version of the scorer whose scores are plotted, see get_scores (default = 'HeCaToS_ChEMBLLIKE')'''
     
     get_ipython().magic('matplotlib inline')
     
-    conn = lite.connect(db_name)
+    conn = _connect(db_name)
     cursor = conn.cursor()
     
     query_id = str(query_id_list).strip('[]')
-    cursor.execute('select score from scores where pmid in (select distinct pmid from result_ids where query_id in ({}))'.format(query_id))
+    cursor.execute('select score from scores where scorer_version = ? and pmid in (select distinct pmid from result_ids where query_id in ({}))'.format(query_id), (scorer_version,))
     
     score_list = [i[0] for i in cursor.fetchall()]
     score_array = np.array(score_list)
@@ -1125,6 +2296,114 @@ def plot_scores(query_id_list, db_name, figure_title):
     conn.close()
     
 
+# In[ ]:
+
+# tables of a snapshot: (sql, arrow schema, partition column or None). article_data is read from article_text, so the text is never compressed in a snapshot
+_SNAPSHOT_TABLES = {'result_ids': ('select query_id, pmid from result_ids',
+                                   pa.schema([('query_id', pa.int64()), ('pmid', pa.int64())]), 'query_id'),
+                    'article_data': ('''select pmid, year, title, abstract, journal_title, journal_abbrev_title, in_epmc, avail_codes, pdf_links, other_links, in_chembl
+                                       from article_text''',
+                                     pa.schema([('pmid', pa.int64()), ('year', pa.int64()), ('title', pa.string()), ('abstract', pa.string()), ('journal_title', pa.string()),
+                                                ('journal_abbrev_title', pa.string()), ('in_epmc', pa.int64()), ('avail_codes', pa.string()), ('pdf_links', pa.string()),
+                                                ('other_links', pa.string()), ('in_chembl', pa.int64())]), 'year'),
+                    'scores': ('select pmid, score, scorer_version from scores',
+                               pa.schema([('pmid', pa.int64()), ('score', pa.float64()), ('scorer_version', pa.string())]), None),
+                    'article_links': ('select pmid, campus_links, request_access from article_links',
+                                      pa.schema([('pmid', pa.int64()), ('campus_links', pa.string()), ('request_access', pa.string())]), None)}
+
+def export_snapshot(db_name, directory, query_id_list = None, file_format = 'arrow', batch_size = 50000):
+    '''Write the result_ids, article_data, scores and article_links tables to a directory of Arrow IPC or Parquet files, to be opened with load_snapshot.
+    Every table goes in its own subdirectory, result_ids partitioned per query_id and article_data per year (query_id=N and year=N directories).
+    The rows are read from the db and written in batches of batch_size, an existing snapshot in directory is replaced.
+    kwargs: db_name -- name of SQLite database
+            directory -- directory to write the snapshot to
+            query_id_list -- only export these queries and their articles, None for the whole db (default = None)
+            file_format -- 'arrow' for Arrow IPC files, which load_snapshot memory-maps, or 'parquet' for smaller files (default = 'arrow')
+            batch_size -- number of rows read from the db at a time (default = 50000)'''
+    
+    assert file_format in ('arrow', 'parquet'), "file_format should be 'arrow' or 'parquet'"
+    
+    conn = _connect(db_name)
+    
+    # only reads, so other processes can keep writing to the db during a long export
+    params = [] if query_id_list is None else list(query_id_list)
+    
+    for table, (sql, schema, partition_column) in _SNAPSHOT_TABLES.items():
+        
+        if query_id_list is not None:
+            if table == 'result_ids':
+                sql += ' where query_id in ({})'.format(', '.join('?' * len(params)))
+            else:
+                sql += ' where pmid in (select r.pmid from result_ids r where r.query_id in ({}))'.format(', '.join('?' * len(params)))
+        
+        cursor = conn.execute(sql, params)
+        table_directory = os.path.join(directory, table)
+        shutil.rmtree(table_directory, ignore_errors = True)
+        batch_nr = 0
+        
+        # every batch is written separately (part-<batch>-<i> in each partition): write_dataset reads an iterator from its own threads, and the cursor can only be used from this thread
+        while True:
+            
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            
+            batch = pa.Table.from_arrays([pa.array(column, type = field.type) for column, field in zip(zip(*rows), schema)], schema = schema)
+            ds.write_dataset(batch, table_directory, format = 'ipc' if file_format == 'arrow' else 'parquet',
+                             partitioning = [partition_column] if partition_column else None, partitioning_flavor = 'hive' if partition_column else None,
+                             basename_template = 'part-{}-{{i}}.{}'.format(batch_nr, file_format), existing_data_behavior = 'overwrite_or_ignore')
+            batch_nr += 1
+    
+    conn.close()
+    
+    return None
+
+
+def load_snapshot(directory, table, query_id_list = None):
+    '''Open a table of a snapshot made with export_snapshot. Arrow IPC files are memory-mapped, so no data is copied or parsed: opening is fast also for
+    large snapshots, and several processes opening the same snapshot share the pages in memory. Parquet files are read.
+    Returns a pyarrow Table, use .to_pandas() for a dataframe (that does copy the data).
+    kwargs: directory -- directory of the snapshot
+            table -- 'result_ids', 'article_data', 'scores' or 'article_links'
+            query_id_list -- only the rows of these queries (for the other tables: of the pmids of these queries), None for all rows (default = None)'''
+    
+    schema, partition_column = _SNAPSHOT_TABLES[table][1:]
+    tables = []
+    
+    for root, dirs, files in sorted(os.walk(os.path.join(directory, table))):
+        
+        # the value of the partition column is in the name of the directory, e.g. query_id=3
+        partition_value = None
+        if partition_column is not None and os.path.basename(root).startswith(partition_column + '='):
+            partition_value = os.path.basename(root).split('=', 1)[1]
+            if table == 'result_ids' and query_id_list is not None and int(partition_value) not in query_id_list:
+                continue
+        
+        for file_name in sorted(files):
+            
+            path = os.path.join(root, file_name)
+            
+            if file_name.endswith('.arrow'):
+                part = pa.ipc.open_file(pa.memory_map(path)).read_all()
+            elif file_name.endswith('.parquet'):
+                part = pq.read_table(path, memory_map = True)
+            else:
+                continue
+            
+            if partition_column is not None:
+                value = None if partition_value in (None, '__HIVE_DEFAULT_PARTITION__') else int(partition_value)
+                part = part.append_column(partition_column, pa.array([value] * part.num_rows, type = pa.int64()))
+            
+            tables.append(part.select(schema.names))
+    
+    snapshot_table = pa.concat_tables(tables) if tables else schema.empty_table()
+    
+    if query_id_list is not None and table != 'result_ids':
+        pmids = load_snapshot(directory, 'result_ids', query_id_list).column('pmid')
+        snapshot_table = snapshot_table.filter(pc.is_in(snapshot_table.column('pmid'), value_set = pc.unique(pmids)))
+    
+    return snapshot_table
+
 
 # In[ ]:
 